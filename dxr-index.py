@@ -1,13 +1,20 @@
 #!/usr/bin/env python
 
-from multiprocessing import cpu_count
-from multiprocessing.pool import ThreadPool as Pool
+from multiprocessing import cpu_count, Pool, Process
+from multiprocessing.pool import ThreadPool
+from cStringIO import StringIO
 from itertools import chain
 import dxr
 import dxr.htmlbuilders
 import dxr.languages
+import dxr.manifest
+import dxr.objstore
+import dxr.pipeline
+import dxr.plugins
+import dxr.stopwatch
 import getopt
 import glob
+import json
 import os
 import shutil
 import sqlite3
@@ -17,6 +24,8 @@ import sys
 import time
 import ctypes
 import tempfile
+import threading
+import traceback
 
 # At this point in time, we've already compiled the entire build, so it is time
 # to collect the data. This process can be viewed as a pipeline.
@@ -34,10 +43,16 @@ Options:
   -f, --file    FILE                      Use FILE as config file (default is ./dxr.config).
   -t, --tree    TREE                      Index and Build only section TREE (default is all).
   -c, --create  [xref|html]               Create xref or html and index (default is all).
+  -i, --incremental                       Reuse the search index of files that did not
+                                          change since the current generation.
+  -j, --jobs    N                         Index up to N trees at the same time (default is 1).
   -d, --debug   glob                      Only generate HTML for the file(s)."""
 
 big_blob = None
 
+# Instrumentation of the tree being indexed; see indextree
+watch = None
+
 def WriteOpenSearch(name, hosturl, virtroot, wwwdir):
   try:
     fp = open(os.path.join(wwwdir, 'opensearch-' + name + '.xml'), 'w')
@@ -56,132 +71,365 @@ def WriteOpenSearch(name, hosturl, virtroot, wwwdir):
     print('Error writing opensearchfile (%s): %s' % (name, sys.exc_info()[1]))
     return None
 
-def async_toHTML(treeconfig, srcpath, dstfile, dbdir):
-  conn = getdbconn(treeconfig, dbdir)
-
-  """Wrapper function to allow doing this async without an instance method."""
+# Per-process state of the HTML workers, set up by init_html_worker.
+html_treecfg = None
+html_conn = None
+html_store = None
+
+def init_html_worker(treecfg, dbdir, store):
+  """ Pool initializer: every HTML worker gets its own read-only connection. """
+  global html_treecfg, html_conn, html_store
+  html_treecfg = treecfg
+  html_conn = getdbconn(treecfg, dbdir, readonly=True)
+  html_store = store
+
+def async_toHTML(job):
+  """Wrapper function to allow doing this async without an instance method.
+     The page is rendered in memory and linked from the object store, so it is
+     only written if no generation has the same page yet.
+     Returns (srcpath, error, seconds, size), where error is None on success
+     and size is the number of bytes written."""
+  srcpath, dstfile = job
+  start = time.time()
   try:
-    dxr.htmlbuilders.make_html(srcpath, dstfile, treeconfig, big_blob, conn)
+    out = StringIO()
+    dxr.htmlbuilders.make_html(srcpath, dstfile, html_treecfg, big_blob,
+                               html_conn, out)
+    data = out.getvalue()
+    size = dxr.objstore.put(html_store, data, dstfile) and len(data) or 0
   except Exception, e:
-    print 'Error on file %s:' % srcpath
-    import traceback
-    traceback.print_exc()
-  finally:
-    conn.close()
+    return (srcpath, traceback.format_exc(), time.time() - start, 0)
+  return (srcpath, None, time.time() - start, size)
 
-def make_index(file_list, dbdir, treecfg):
-  conn = getdbconn(treecfg, dbdir)
+def getworkers(treecfg):
+  """ Returns the number of worker processes to use for the tree. """
+  try:
+    return max(1, int(treecfg.workers))
+  except AttributeError:
+    return cpu_count()
+
+def carry_index(conn, prevdb, paths):
+  """ Copies the full-text rows of the given files from a previous database.
+      Returns the set of paths whose rows were found and copied. """
+  # ATTACH would create an empty database in its place
+  if not os.path.exists(prevdb):
+    print 'No previous database at %s, indexing all files' % prevdb
+    return set()
+  conn.execute('ATTACH DATABASE ? AS prev', (prevdb,))
+  try:
+    conn.execute('CREATE TEMP TABLE carried (path VARCHAR(1024) PRIMARY KEY)')
+    conn.executemany('INSERT INTO carried (path) VALUES (?)',
+                     ((path,) for path in paths))
+    conn.execute('INSERT OR IGNORE INTO files (path) SELECT path FROM carried')
+    conn.execute('INSERT INTO fts (rowid, basename, content) ' +
+                 'SELECT files.ID, prevfts.basename, prevfts.content ' +
+                 'FROM carried JOIN files ON files.path = carried.path ' +
+                 'JOIN prev.files AS prevfiles ON prevfiles.path = carried.path ' +
+                 'JOIN prev.fts AS prevfts ON prevfts.rowid = prevfiles.ID')
+    copied = set(row[0] for row in conn.execute('SELECT files.path FROM ' +
+      'carried JOIN files ON files.path = carried.path ' +
+      'WHERE files.ID IN (SELECT rowid FROM fts)'))
+    conn.commit()
+    conn.execute('DROP TABLE carried')
+  finally:
+    conn.execute('DETACH DATABASE prev')
+  return copied
 
-  conn.execute('DROP TABLE IF EXISTS fts')
-  conn.execute('CREATE VIRTUAL TABLE fts USING fts4 (basename, content, tokenize=dxrCodeTokenizer)')
-  cur = conn.cursor();
+# Number of files whose full-text rows are inserted per transaction. While one
+# batch is inserted, the reader threads already load the next one.
+fts_batch_size = 256
 
-  for fname in file_list:
+def read_source(fname):
+  """ Reads a file for the full-text index. Returns (relpath, contents), with
+      contents being None if the file could not be read. """
+  try:
+    f = open(fname[1], 'r')
     try:
-      f = open(fname[1], 'r')
+      return (fname[0], f.read())
+    finally:
+      f.close()
+  except IOError:
+    print "Error reading '%s' for FTS: %s" % (fname[0], sys.exc_info()[1])
+    return (fname[0], None)
+
+def insert_fts_rows(conn, rows):
+  """ Inserts (rowid, basename, content) rows into the fts table. If the batch
+      fails as a whole, the rows are retried one by one to find the culprit. """
+  sql = 'INSERT INTO fts (rowid, basename, content) VALUES (?, ?, ?)'
+  watch.count('fts rows', len(rows))
+  try:
+    conn.executemany(sql, rows)
+  except sqlite3.Error:
+    conn.rollback()
+    for row in rows:
+      try:
+        conn.execute(sql, row)
+      except sqlite3.Error:
+        print "Error inserting FTS for file '%s': %s" % (row[1], sys.exc_info()[1])
+  conn.commit()
 
-      row = cur.execute("SELECT ID FROM files WHERE path = ?", (fname[0],)).fetchone()
+# The HTML workers are forked while the full-text index is still being built. A
+# child that inherits one of sqlite's mutexes locked hangs as soon as it uses
+# sqlite, so make_index and fill_index only use sqlite while holding this lock,
+# which start_html_workers takes to fork.
+sqlite_lock = threading.Lock()
+
+def make_index(file_list, dbdir, treecfg, prevdb=None, carried=None):
+  """ Creates the full-text index and fills it with the given files. Files in
+      carried keep the rows of the previous database. Returns the number of
+      files that were read. """
+  with sqlite_lock:
+    conn = getdbconn(treecfg, dbdir)
 
-      if row is None:
-        cur.execute ("INSERT INTO files (path) VALUES (?)", (fname[0],))
-        rowid = cur.lastrowid
-      else:
-        rowid = row[0]
+    conn.execute('DROP TABLE IF EXISTS fts')
+    conn.execute('CREATE VIRTUAL TABLE fts USING fts4 (basename, content, tokenize=dxrCodeTokenizer)')
+    conn.commit()
 
-      cur.execute('INSERT INTO fts (rowid, basename, content) VALUES (?, ?, ?)',
-                  (rowid, os.path.basename (fname[0]), f.read ()))
-      f.close()
+    # Unchanged files keep the rows of the previous generation
+    if carried:
+      try:
+        carried = carry_index(conn, prevdb, carried)
+      except sqlite3.Error:
+        print "Unable to reuse the previous full-text index: %s" % sys.exc_info()[1]
+        carried = None
+  if carried:
+    todo = [fname for fname in file_list if fname[0] not in carried]
+  else:
+    todo = file_list
 
-      if cur.lastrowid % 100 == 0:
-        conn.commit()
-    except:
-      print "Error inserting FTS for file '%s': %s" % (fname[0], sys.exc_info()[1])
+  try:
+    fill_index(conn, treecfg, todo)
+  finally:
+    with sqlite_lock:
+      conn.close()
+  return len(todo)
+
+def fill_index(conn, treecfg, todo):
+  """ Adds the full-text rows of the (relpath, srcpath) files in todo. """
+  # Load the path -> ID map in one go, giving IDs to the files that are not in
+  # the files table yet.
+  fileids = {}
+  with sqlite_lock:
+    for row in conn.execute('SELECT path, ID FROM files'):
+      fileids[row[0]] = row[1]
+    missing = [(fname[0],) for fname in todo if fname[0] not in fileids]
+    if missing:
+      conn.executemany('INSERT OR IGNORE INTO files (path) VALUES (?)', missing)
+      conn.commit()
+      for row in conn.execute('SELECT path, ID FROM files'):
+        fileids[row[0]] = row[1]
+
+  # Read the sources in background threads, one batch ahead of the inserts.
+  batches = [todo[i:i + fts_batch_size]
+             for i in xrange(0, len(todo), fts_batch_size)]
+  readers = ThreadPool(processes=min(8, getworkers(treecfg)))
+  try:
+    pending = batches and readers.map_async(read_source, batches[0])
+    for i in xrange(len(batches)):
+      contents = pending.get()
+      watch.count('fts bytes', sum(len(content) for path, content in contents
+                                   if content is not None))
+      if i + 1 < len(batches):
+        pending = readers.map_async(read_source, batches[i + 1])
+      rows = [(fileids[path], os.path.basename(path), content)
+              for path, content in contents if content is not None]
+      with sqlite_lock:
+        insert_fts_rows(conn, rows)
+  finally:
+    readers.close()
+    readers.join()
 
-  cur.close()
-  conn.commit()
-  conn.close()
+def merge_index(file_list, dbdir, treecfg):
+  """ Adds the given files to the full-text index built by make_index, then
+      merges all the segments written by the batches into a single b-tree. """
+  conn = getdbconn(treecfg, dbdir)
+  try:
+    fill_index(conn, treecfg, file_list)
+    conn.execute("INSERT INTO fts (fts) VALUES ('optimize')")
+    conn.commit()
+  finally:
+    conn.close()
+  return len(file_list)
 
 
-def make_index_html(treecfg, dirname, fnames, htmlroot):
-  genroot = os.path.relpath(dirname, htmlroot)
-  if genroot.startswith('./'): genroot = genroot[2:]
-  if genroot.startswith('--GENERATED--'):
-    srcpath = treecfg.objdir
-    genroot = genroot[len("--GENERATED--") + 1:]
-  else:
-    srcpath = treecfg.sourcedir
-  srcpath = os.path.join(srcpath, genroot)
-  of = open(os.path.join(dirname, 'index.html'), 'w')
+def stat_dirs(treecfg, reldir, dirstats):
+  """ Records the mtime of the source directory of reldir, and of all of its
+      parents, in dirstats. """
+  while reldir not in dirstats:
+    if reldir == '--GENERATED--':
+      srcdir = treecfg.objdir # Meh, good enough
+    elif reldir.startswith('--GENERATED--/'):
+      srcdir = os.path.join(treecfg.objdir, reldir[len('--GENERATED--/'):])
+    else:
+      srcdir = os.path.join(treecfg.sourcedir, reldir)
+    try:
+      dirstats[reldir] = os.stat(srcdir).st_mtime
+    except OSError:
+      dirstats[reldir] = 0
+    if reldir == '':
+      break
+    reldir = os.path.dirname(reldir)
+
+def get_index_jobs(manifest, dirstats):
+  """ Returns the directory listings to generate, as a list of
+      (reldir, dirs, files) tuples. dirs and files are sorted lists of
+      (name, mtime, size) tuples, taken from the manifest and dirstats. Hidden
+      files and directories are not listed. """
+  listings = {}
+  for path, entry in manifest.iteritems():
+    parts = path.split('/')
+    if any(part[0] == '.' for part in parts):
+      continue
+    reldir = '/'.join(parts[:-1])
+    dirs, files = listings.setdefault(reldir, ({}, []))
+    if entry['text']:
+      files.append((parts[-1], entry['mtime'], entry['size']))
+    # Make sure that all of the parents list this directory
+    while reldir:
+      parent, name = os.path.split(reldir)
+      dirs = listings.setdefault(parent, ({}, []))[0]
+      if name in dirs:
+        break
+      dirs[name] = (name, dirstats.get(reldir, 0), None)
+      reldir = parent
+  return [(reldir, sorted(dirs.itervalues()), sorted(files))
+          for reldir, (dirs, files) in listings.iteritems()]
+
+# Per-process state of the directory listing workers, set up by
+# init_index_worker: the templates are only read and expanded once.
+index_treecfg = None
+index_header = None
+index_footer = None
+
+def init_index_worker(treecfg, header, footer):
+  global index_treecfg, index_header, index_footer
+  index_treecfg, index_header, index_footer = treecfg, header, footer
+
+def make_index_html(job):
+  """ Writes the index.html of a directory from a get_index_jobs tuple. Returns
+      (dirname, error), where error is None on success. """
+  dirname, dirs, files = job
+  treecfg = index_treecfg
   try:
-    html_header = treecfg.getTemplateFile("dxr-header.html")
-    of.write(html_header.replace('${sidebarActions}', '\n'))
-    of.write('''<div id="maincontent" dojoType="dijit.layout.ContentPane"
+    out = ['''<div id="maincontent" dojoType="dijit.layout.ContentPane"
       region="center"><table id="index-list">
         <tr><th></th><th>Name</th><th>Last modified</th><th>Size</th></tr>
-      ''')
-    of.write('<tr><td><img src="%s/images/icons/folder.png"></td>' %
+      ''']
+    out.append('<tr><td><img src="%s/images/icons/folder.png"></td>' %
       treecfg.virtroot)
-    of.write('<td><a href="..">Parent directory</a></td>')
-    of.write('<td></td><td>-</td></tr>')
-    torm = []
-    fnames.sort()
-    dirs, files = [], []
-    for fname in fnames:
-      # Ignore hidden files
-      if fname[0] == '.':
-        torm.append(fname)
-        continue
-      fullname = os.path.join(dirname, fname)
-
-      # Directory ?
-      if os.path.isdir(fullname):
-        img = 'folder.png'
-        link = fname
-        display = fname + '/'
-        if fname == '--GENERATED--':
-          stat = os.stat(treecfg.objdir) # Meh, good enough
+    out.append('<td><a href="..">Parent directory</a></td>')
+    out.append('<td></td><td>-</td></tr>')
+    for entries, img in ((dirs, 'folder.png'), (files, 'page_white.png')):
+      for fname, mtime, size in entries:
+        if size is None:
+          link = fname
+          display = fname + '/'
+          size = '-'
         else:
-          stat = os.stat(os.path.join(srcpath, fname))
-        size = '-'
-        add = dirs
-      else:
-        img = 'page_white.png'
-        link = fname
-        display = fname[:-5] # Remove .html
-        stat = os.stat(os.path.join(srcpath, display))
-        size = stat.st_size
-        if size > 2 ** 30:
-          size = str(size / 2 ** 30) + 'G'
-        elif size > 2 ** 20:
-          size = str(size / 2 ** 20) + 'M'
-        elif size > 2 ** 10:
-          size = str(size / 2 ** 10) + 'K'
-        else:
-          size = str(size)
-        add = files
-      add.append('<tr><td><img src="%s/images/icons/%s"></td>' %
-        (treecfg.virtroot, img))
-      add.append('<td><a href="%s">%s</a></td>' % (link, display))
-      add.append('<td>%s</td><td>%s</td>' % (
-        time.strftime('%Y-%b-%d %H:%m', time.gmtime(stat.st_mtime)), size))
-      add.append('</tr>')
-    of.write(''.join(dirs))
-    of.write(''.join(files))
-    of.flush()
-    of.write(treecfg.getTemplateFile("dxr-footer.html"))
-
-    for f in torm:
-      fnames.remove(f)
-  except:
-    sys.excepthook(*sys.exc_info())
+          link = fname + '.html'
+          display = fname
+          if size > 2 ** 30:
+            size = str(size / 2 ** 30) + 'G'
+          elif size > 2 ** 20:
+            size = str(size / 2 ** 20) + 'M'
+          elif size > 2 ** 10:
+            size = str(size / 2 ** 10) + 'K'
+          else:
+            size = str(size)
+        out.append('<tr><td><img src="%s/images/icons/%s"></td>' %
+          (treecfg.virtroot, img))
+        out.append('<td><a href="%s">%s</a></td>' % (link, display))
+        out.append('<td>%s</td><td>%s</td>' % (
+          time.strftime('%Y-%b-%d %H:%m', time.gmtime(mtime)), size))
+        out.append('</tr>')
+
+    of = open(os.path.join(treecfg.htmlroot, dirname, 'index.html'), 'w')
+    try:
+      of.write(index_header)
+      of.write(''.join(out))
+      of.write(index_footer)
+    finally:
+      of.close()
+  except Exception:
+    return (dirname, traceback.format_exc())
+  return (dirname, None)
+
+def start_listing_workers(treecfg):
+  """ Starts the worker processes for make_listings. Like all workers, they
+      must be forked while no other thread uses sqlite; see
+      start_html_workers. """
+  header = treecfg.getTemplateFile("dxr-header.html")
+  header = header.replace('${sidebarActions}', '\n')
+  footer = treecfg.getTemplateFile("dxr-footer.html")
+  return Pool(processes=getworkers(treecfg), initializer=init_index_worker,
+              initargs=(treecfg, header, footer))
+
+def make_listings(treecfg, p, manifest, dirstats, only=None):
+  """ Generates the index.html files from the stat data collected in the
+      manifest, instead of walking both the output and the source trees again.
+      The files are written in the workers of start_listing_workers. If only is
+      given, just the listings of the directories it accepts are written.
+      Returns the number of listings. """
+  index_jobs = get_index_jobs(manifest, dirstats)
+  if only is not None:
+    index_jobs = [job for job in index_jobs if only(job[0])]
+  n = getworkers(treecfg)
+  for dirname, error in p.imap_unordered(make_index_html, index_jobs,
+                                         max(1, len(index_jobs) / (n * 4))):
+    if error is not None:
+      print 'Error generating the index of %s:' % (dirname or '/')
+      print error
+  watch.count('listings', len(index_jobs))
+  return len(index_jobs)
+
+def start_html_workers(treecfg, dbdir, store):
+  """ Starts the worker processes for make_pages. Each worker opens its own
+      connection to the database.
+
+      The workers are forked from a process whose other threads may be using
+      sqlite at that moment. A child that inherits one of sqlite's mutexes
+      locked hangs as soon as it opens its connection, so this must only be
+      called while no other stage uses the database, except for the full-text
+      index; see sqlite_lock. """
+  with sqlite_lock:
+    return Pool(processes=getworkers(treecfg), initializer=init_html_worker,
+                initargs=(treecfg, dbdir, store))
+
+def make_pages(treecfg, p, html_jobs):
+  """ Renders the (srcpath, dstfile) jobs in the workers of start_html_workers,
+      and stops them. Files are handed out in chunks so that the per-task
+      overhead stays small compared to the rendering itself. Returns the number
+      of pages. """
+  n = getworkers(treecfg)
+  chunksize = max(1, min(64, len(html_jobs) / (n * 4)))
+  errors = []
+  try:
+    for srcpath, error, seconds, size in p.imap_unordered(async_toHTML,
+                                                          html_jobs, chunksize):
+      watch.sample('html', srcpath, seconds)
+      watch.count('html bytes', size)
+      if error is not None:
+        print 'Error on file %s:' % srcpath
+        print error
+        errors.append(srcpath)
   finally:
-    of.close()
+    p.close()
+    p.join()
+  if errors:
+    print 'Failed to build HTML for %d of %d files' % (len(errors), len(html_jobs))
+  return len(html_jobs)
 
-def getdbconn(treecfg, dbdir):
+# Stages write to the database concurrently, so wait for the others to commit
+# instead of failing with "database is locked".
+db_timeout = 600
+
+def getdbconn(treecfg, dbdir, readonly=False):
   dbname = treecfg.tree + '.sqlite'
-  conn = sqlite3.connect(os.path.join(dbdir, dbname))
+  conn = sqlite3.connect(os.path.join(dbdir, dbname), timeout=db_timeout)
   conn.execute('PRAGMA synchronous=off')
   conn.execute('PRAGMA page_size=65536')
+  if readonly:
+    conn.execute('PRAGMA query_only=1')
   # Safeguard against non-ASCII text. Let's just hope everyone uses UTF-8
   conn.text_factory = str
   conn.row_factory = sqlite3.Row
@@ -191,41 +439,140 @@ def getdbconn(treecfg, dbdir):
 
   return conn
 
-
-def builddb(treecfg, dbdir, tmproot):
-  """ Post-process the build and make the SQL directory """
-  global big_blob
-
+def createdb(treecfg, dbdir):
+  """ Creates the tables of the language schema and of all plugins """
   # Build the sql for later queries. This is a combination of the main language
   # schema as well as plugin-specific information. The pragmas that are
   # executed should make the sql stage go faster.
   print "Building SQL..."
   conn = getdbconn(treecfg, dbdir)
 
-  # We use this all over the place, cache it here.
-  plugins = dxr.get_active_plugins(treecfg)
+  # While the stages fill the database, the HTML workers read it. In WAL mode
+  # the readers do not block the writers; see finishdb.
+  conn.execute('PRAGMA journal_mode=WAL')
 
   # Import the schemata
   schemata = [dxr.languages.get_standard_schema()]
-  for plugin in plugins:
+  for plugin in dxr.get_active_plugins(treecfg):
     schemata.append(plugin.get_schema())
   conn.executescript('\n'.join(schemata))
   conn.commit()
+  conn.close()
+
+def reusedb(treecfg, prevdbdir, dbdir):
+  """ Takes the database and the plugin data over from the previous generation,
+      for runs that only build the HTML. The plugin data is only read, so it is
+      linked; the database gets a new full-text index, so it is copied. """
+  dbname = treecfg.tree + '.sqlite'
+  if not os.path.exists(os.path.join(prevdbdir, dbname)):
+    print 'Error: %s has not been indexed yet' % treecfg.tree
+    sys.exit(1)
+  shutil.copyfile(os.path.join(prevdbdir, dbname), os.path.join(dbdir, dbname))
+  for name in dxr.blob_files:
+    if os.path.exists(os.path.join(prevdbdir, name)):
+      dxr.objstore.link_or_copy(os.path.join(prevdbdir, name),
+                                os.path.join(dbdir, name))
+  conn = getdbconn(treecfg, dbdir)
+  conn.execute('PRAGMA journal_mode=WAL')
+  conn.close()
+
+def finishdb(treecfg, dbdir):
+  """ Switches the database back to a rollback journal, so that the CGI
+      scripts can read it without write access to its directory. """
+  conn = getdbconn(treecfg, dbdir)
+  conn.execute('PRAGMA journal_mode=DELETE')
+  conn.close()
+
+def run_post_process(plugin, treecfg, blob):
+  """ Runs the post_process of the plugin, and stores its result in blob """
+  with watch.span(plugin.__name__, 'plugin'):
+    with watch.span('post_process'):
+      blob[plugin.__name__] = plugin.post_process(treecfg.sourcedir,
+                                                  treecfg.objdir)
+
+def run_build_database(plugin, treecfg, dbdir, blob):
+  """ Runs the build_database of the plugin on a connection of its own """
+  conn = getdbconn(treecfg, dbdir)
+  try:
+    with watch.span(plugin.__name__, 'plugin'):
+      with watch.span('build_database'):
+        plugin.build_database(conn, treecfg.sourcedir, treecfg.objdir,
+                              blob.get(plugin.__name__))
+        watch.count('rows', conn.total_changes)
+    conn.commit()
+  finally:
+    conn.close()
+
+def builddb(treecfg, dbdir, tmproot):
+  """ Post-process the build and fill the SQL database """
+  global big_blob
+
+  # We use this all over the place, cache it here.
+  plugins = dxr.get_active_plugins(treecfg)
 
   # Building the database--this happens as multiple phases. In the first phase,
   # we basically collect all of the information and organizes it. In the second
   # phase, we link the data across multiple languages.
-  big_blob = {}
-  srcdir = treecfg.sourcedir
-  objdir = treecfg.objdir
+  #
+  # The post_process of all plugins runs at once. The build_database of a
+  # plugin runs once its post_process is done, after the build_database of the
+  # earlier plugins that use the same tables; see get_table_access.
+  blob = {}
+  pipeline = dxr.pipeline.Pipeline(treecfg.tree + '/xref', watch)
+  writers = []
   for plugin in plugins:
-    cache = None
-
+    name = plugin.__name__.split('.')[-1]
+    deps = []
     if 'post_process' in plugin.__all__:
-      big_blob[plugin.__name__] = cache = plugin.post_process(srcdir, objdir)
+      pipeline.add_stage(name,
+                         lambda plugin=plugin: run_post_process(plugin, treecfg,
+                                                                blob))
+      deps.append(name)
 
     if 'build_database' in plugin.__all__:
-      plugin.build_database(conn, srcdir, objdir, cache)
+      access = None
+      if 'get_table_access' in plugin.__all__:
+        access = plugin.get_table_access()
+      for stage, other in writers:
+        if dxr.plugins.tables_conflict(access, other):
+          deps.append(stage)
+      pipeline.add_stage(name + '/db',
+                         lambda plugin=plugin: run_build_database(plugin,
+                                                                  treecfg,
+                                                                  dbdir, blob),
+                         deps)
+      writers.append((name + '/db', access))
+  pipeline.run()
+  big_blob = blob
+
+  # The tables were filled without their indexes. Once every plugin has written
+  # its rows, the rows that the unique indexes would have ignored are removed,
+  # and the plugins link their data, one after the other. The lookup indexes
+  # come last, and then the statistics of the final database are gathered for
+  # the query planner.
+  print "Building indexes..."
+  conn = getdbconn(treecfg, dbdir)
+  with watch.span('dedup'):
+    dxr.languages.language_schema.build_indexes(conn, lookups=False)
+    for plugin in plugins:
+      if 'build_indexes' in plugin.__all__:
+        plugin.build_indexes(conn, lookups=False)
+    conn.commit()
+  for plugin in plugins:
+    if 'link_database' in plugin.__all__:
+      with watch.span(plugin.__name__, 'plugin'):
+        with watch.span('link_database'):
+          plugin.link_database(conn, treecfg.sourcedir, treecfg.objdir,
+                               blob.get(plugin.__name__))
+      conn.commit()
+  with watch.span('indexes'):
+    dxr.languages.language_schema.build_indexes(conn)
+    for plugin in plugins:
+      if 'build_indexes' in plugin.__all__:
+        plugin.build_indexes(conn)
+    conn.commit()
+    conn.execute('ANALYZE')
+  conn.commit()
 
   # Save off the raw data blob
 #  print "Storing data..."
@@ -248,13 +595,32 @@ def builddb(treecfg, dbdir, tmproot):
 #      conn.execute(stmt)
   conn.commit()
   conn.close()
-
-def indextree(treecfg, doxref, dohtml, debugfile):
-  global big_blob
+  return len(plugins)
+
+def store_blob(treecfg, tmproot):
+  """ Lets the plugins prepare their data for the htmlifiers, and stores it.
+      From then on, the per-file plugin data is only read as pages need it. """
+  # Do we need to do file pivoting?
+  for plugin in dxr.get_active_plugins(treecfg):
+    if plugin.__name__ in big_blob:
+      with watch.span(plugin.__name__, 'plugin'):
+        with watch.span('pre_html_process'):
+          plugin.pre_html_process(treecfg, big_blob[plugin.__name__])
+
+  with watch.span('spill'):
+    dxr.spill_big_blob(treecfg, big_blob, tmproot)
+
+def indextree(treecfg, doxref, dohtml, debugfile, incremental=False):
+  """ Indexes a single tree. index_trees runs this in a process of its own, so
+      that module state like big_blob and the plugin globals is per tree. """
+  global big_blob, watch
+  big_blob = None
+  dxr.plugins.workers = getworkers(treecfg)
 
   # dxr xref files (index + sqlitedb) go in wwwdir/treename-current/.dxr_xref
   # and we'll symlink it to wwwdir/treename later
   htmlroot = os.path.join(treecfg.wwwdir, treecfg.tree + '-current')
+  prevdbdir = os.path.join(htmlroot, '.dxr_xref')
   oldroot = os.path.join(treecfg.wwwdir, treecfg.tree + '-old')
   tmproot = tempfile.mkdtemp(prefix = (os.path.join(treecfg.wwwdir, '.' + treecfg.tree + '.')))
   linkroot = os.path.join(treecfg.wwwdir, treecfg.tree)
@@ -262,105 +628,213 @@ def indextree(treecfg, doxref, dohtml, debugfile):
   dbdir = os.path.join(tmproot, '.dxr_xref')
   os.makedirs(dbdir, 0755)
   dbname = treecfg.tree + '.sqlite'
-
-  retcode = 0
+  treecfg.database = os.path.join(dbdir, dbname)
+  dxr.plugins.set_id_database(treecfg.database)
+  store = dxr.objstore.get_store(treecfg.wwwdir)
+
+  # The indexing is split into stages, which run as soon as the stages they
+  # depend on are done:
+  #
+  #   schema -> walk -> xref -----> generated -> htmlworkers -> html
+  #                 \-> fts ------------------> ftsmerge (needs generated,
+  #                 |                                    htmlworkers)
+  #                 \-> dirs -----------------> gendirs (needs generated)
+  #
+  # fts and dirs work on what the walk found. The files that plugins generate
+  # are added to the full-text index by ftsmerge, and to the listings by
+  # gendirs.
+  #
+  # The xref stage (the plugins) is by far the longest one, so the full-text
+  # index and the directory listings are built while it runs. Only the files
+  # that plugins generate have to wait for it.
+  watch = dxr.stopwatch.StopWatch()
+  pipeline = dxr.pipeline.Pipeline(treecfg.tree, watch)
+  # The worker pools that are started before the stages, and stopped once
+  # they are done
+  pools = []
   if doxref:
-    builddb(treecfg, dbdir, tmproot)
+    # The plugins parse their files in a shared pool, which has to know their
+    # functions
+    dxr.import_plugins(dxr.get_active_plugins(treecfg))
+    dxr.plugins.start_pool()
+    pipeline.add_stage('schema', lambda: createdb(treecfg, dbdir))
+    pipeline.add_stage('xref', lambda: builddb(treecfg, dbdir, tmproot),
+                       ['schema'])
+  elif dohtml:
+    reusedb(treecfg, prevdbdir, dbdir)
+    if os.path.exists(os.path.join(dbdir, 'index_blob.dat')):
+      big_blob = dxr.load_big_blob(treecfg, tmproot)
+    else:
+      big_blob = {}
 
   # Build static html
   if dohtml:
-#    if not doxref:
-#      big_blob = dxr.load_big_blob(treecfg, tmproot)
-    # Do we need to do file pivoting?
-    for plugin in dxr.get_active_plugins(treecfg):
-      if plugin.__name__ in big_blob:
-        plugin.pre_html_process(treecfg, big_blob[plugin.__name__])
-    dxr.htmlbuilders.build_htmlifier_map(dxr.get_active_plugins(treecfg))
-    treecfg.database = os.path.join(dbdir, dbname)
-
-    n = cpu_count()
-    p = Pool(processes=n)
-
-    print 'Building HTML files for %s...' % treecfg.tree
-
     debug = (debugfile is not None)
 
     index_list = open(os.path.join(dbdir, "file_list.txt"), 'w')
     file_list = []
+    html_jobs = []
 
-    def getOutputFiles():
-      for regular in treecfg.getFileList():
-        yield regular
-      filelist = set()
-      for plug in big_blob:
-        try:
-          filelist.update(big_blob[plug]["byfile"].keys())
-        except KeyError:
-          pass
-        except TypeError:
-          pass
-      for filename in filelist:
-        if filename.startswith("--GENERATED--/"):
-          relpath = filename[len("--GENERATED--/"):]
-          yield filename, os.path.join(treecfg.objdir, relpath)
+    # The manifest of the previous generation tells us which files changed
+    old_manifest = dxr.manifest.load_manifest(prevdbdir)
+    manifest = {}
+    dirstats = {}
+    if incremental and old_manifest == {}:
+      print 'No previous manifest for %s, indexing everything' % treecfg.tree
+      incremental = False
 
     if debugfile:
       output_files = glob.glob (treecfg.sourcedir + '/' + debugfile)
       if output_files == []:
         print 'Error: Glob %s doesn\'t match any files' % debugfile
         sys.exit (1)
-    last_dir = None
-    conn = getdbconn(treecfg, dbdir)
 
-    for f in getOutputFiles():
+    def add_file(f):
+      """ Adds a (relpath, srcpath) file to the manifest and queues its page """
       # In debug mode, we only care about some files
-      if debugfile and not treecfg.sourcedir + '/' + f[0] in output_files: continue
+      if debugfile and not treecfg.sourcedir + '/' + f[0] in output_files:
+        return False
 
-      index_list.write(f[0] + '\n')
       cpypath = os.path.join(tmproot, f[0])
       srcpath = f[1]
+      try:
+        manifest[f[0]] = dxr.manifest.make_entry(srcpath, old_manifest.get(f[0]))
+      except (IOError, OSError):
+        print 'Error reading %s: %s' % (srcpath, sys.exc_info()[1])
+        return False
+      index_list.write(f[0] + '\n')
       file_list.append(f)
+      stat_dirs(treecfg, os.path.dirname(f[0]), dirstats)
 
       # Make output directory
       cpydir = os.path.dirname(cpypath)
       if not os.path.exists(cpydir):
         os.makedirs(cpydir)
 
-      def is_text(srcpath):
-        # xdg.Mime considers .lo as text, which is technically true but useless
-        if srcpath[-3:] == '.lo': return False
-        import xdg.Mime
-        mimetype = str(xdg.Mime.get_type (srcpath))
-        for valid in ['text', 'xml', 'shellscript', 'perl', 'm4', 'xbel', 'javascript']:
-          if valid in mimetype:
-            return True
-        return False
-      if not is_text(srcpath):
-        continue
-#      p.apply_async(async_toHTML, [treecfg, srcpath, cpypath + ".html", dbdir])
-      try:
-        dxr.htmlbuilders.make_html(srcpath, cpypath + ".html", treecfg, big_blob, conn)
-      except Exception, e:
-        print 'Error on file %s:' % srcpath
-        import traceback
-        traceback.print_exc()
-
-    if file_list == []:
+      # Binary files don't get pages
+      if not manifest[f[0]]['text']:
+        return True
+
+      # Every page is rendered again, even for unchanged files: the
+      # cross-references it shows come from the new database. Pages that come
+      # out the same are only linked from the object store.
+      html_jobs.append((srcpath, cpypath + ".html"))
+      return True
+
+    # What the walk found, for the stages that run while the generated stage
+    # may still add files
+    walked = {}
+    def walk():
+      for f in treecfg.getFileList():
+        add_file(f)
+      walked['files'] = list(file_list)
+      walked['manifest'] = dict(manifest)
+      walked['dirstats'] = dict(dirstats)
+
+      if file_list == []:
         print 'Error: No files found to index'
-        sys.exit (0)
-
-    p.apply_async(make_index, [file_list, dbdir, treecfg])
+        return 0
+
+      # Give all files their ID up front, so that the plugins and the full-text
+      # index never race each other for the same path.
+      if doxref:
+        conn = getdbconn(treecfg, dbdir)
+        conn.executemany('INSERT OR IGNORE INTO files (path) VALUES (?)',
+                         ((f[0],) for f in file_list))
+        conn.commit()
+        conn.close()
+      return len(file_list)
+
+    def fts():
+      files = walked['files']
+      carried = None
+      if incremental:
+        added, changed, removed, carried = dxr.manifest.diff_manifests(
+          old_manifest, walked['manifest'])
+        print 'Incremental update: %d added, %d changed, %d removed, %d unchanged' % (
+          len(added), len(changed), len(removed), len(carried))
+      return make_index(files, dbdir, treecfg, os.path.join(prevdbdir, dbname),
+                        carried)
+
+    generated_files = []
+    def generated():
+      # The plugin data of an HTML-only run was stored by the run that built
+      # the database.
+      if doxref:
+        store_blob(treecfg, tmproot)
+      dxr.htmlbuilders.build_htmlifier_map(dxr.get_active_plugins(treecfg))
 
-    index_list.close()
-    p.close()
-    p.join()
+      filelist = set()
+      for plug in big_blob:
+        try:
+          filelist.update(big_blob[plug]["byfile"].keys())
+        except KeyError:
+          pass
+        except TypeError:
+          pass
+      for filename in sorted(filelist):
+        if filename.startswith("--GENERATED--/"):
+          relpath = filename[len("--GENERATED--/"):]
+          f = (filename, os.path.join(treecfg.objdir, relpath))
+          if add_file(f):
+            generated_files.append(f)
+
+      index_list.close()
+      dxr.manifest.store_manifest(dbdir, manifest)
+      return len(generated_files)
+
+    def gendirs():
+      # Generated files only show up in the root listing and below --GENERATED--
+      if not generated_files:
+        return 0
+      return make_listings(treecfg, listing_pool, manifest, dirstats,
+        lambda reldir: reldir.split('/')[0] in ('', '--GENERATED--'))
+
+    treecfg.htmlroot = tmproot
+    # No stage has started yet, so the workers can be forked safely
+    listing_pool = start_listing_workers(treecfg)
+    pools.append(listing_pool)
+    walk_deps = doxref and ['schema'] or []
+    generated_deps = doxref and ['walk', 'xref'] or ['walk']
+    pipeline.add_stage('walk', walk, walk_deps)
+    pipeline.add_stage('fts', fts, ['walk'])
+    pipeline.add_stage('dirs', lambda: make_listings(
+                         treecfg, listing_pool, walked['manifest'],
+                         walked['dirstats']), ['walk'])
+    pipeline.add_stage('generated', generated, generated_deps)
+    # The HTML workers are forked once the plugins are done with the database;
+    # see start_html_workers.
+    html_pool = []
+    def htmlworkers():
+      html_pool.append(start_html_workers(treecfg, dbdir, store))
+      return getworkers(treecfg)
+    pipeline.add_stage('htmlworkers', htmlworkers, ['generated'])
+    pipeline.add_stage('html', lambda: make_pages(treecfg, html_pool[0],
+                                                  html_jobs),
+                       ['htmlworkers'])
+    pipeline.add_stage('ftsmerge',
+                       lambda: merge_index(generated_files, dbdir, treecfg),
+                       ['fts', 'generated', 'htmlworkers'])
+    pipeline.add_stage('gendirs', gendirs, ['dirs', 'generated'])
+
+  # Without pages, the plugin data is stored for a later HTML-only run
+  if doxref and not dohtml:
+    pipeline.add_stage('blob', lambda: store_blob(treecfg, tmproot), ['xref'])
 
-    # Generate index.html files
-    # XXX: This wants to be parallelized. However, I seem to run into problems
-    # if it isn't.
-    def genhtml(treecfg, dirname, fnames):
-      make_index_html(treecfg, dirname, fnames, tmproot)
-    os.path.walk(tmproot, genhtml, treecfg)
+  try:
+    pipeline.run()
+  finally:
+    for p in pools:
+      p.terminate()
+      p.join()
+    dxr.plugins.stop_pool()
+    # Where did the time go? See README for the contents.
+    f = open(os.path.join(dbdir, 'timings.json'), 'w')
+    try:
+      json.dump(watch.report(), f, indent=1, sort_keys=True)
+    finally:
+      f.close()
+  finishdb(treecfg, dbdir)
 
   if os.path.exists(oldroot):
     shutil.rmtree(oldroot)
@@ -377,7 +851,89 @@ def indextree(treecfg, doxref, dohtml, debugfile):
   except:
     pass
 
-def parseconfig(filename, doxref, dohtml, tree, debugfile):
+  # The pages of the generation that was just removed are only linked from the
+  # object store now
+  removed = dxr.objstore.collect(store)
+  if removed:
+    print 'Removed %d unused pages from the object store' % removed
+
+def get_rss(pids):
+  """ Returns a {pid: bytes} dictionary with the resident memory of each of the
+      given processes, including all of their descendants. Without /proc, all
+      of them are reported as 0. """
+  children = {}
+  rss = {}
+  try:
+    allpids = [int(pid) for pid in os.listdir('/proc') if pid.isdigit()]
+  except OSError:
+    return dict((pid, 0) for pid in pids)
+  pagesize = os.sysconf('SC_PAGE_SIZE')
+  for pid in allpids:
+    try:
+      f = open('/proc/%d/stat' % pid)
+      try:
+        stat = f.read()
+      finally:
+        f.close()
+    except IOError:
+      continue
+    # The fields after the command name, starting with the state
+    fields = stat[stat.rindex(')') + 2:].split()
+    children.setdefault(int(fields[1]), []).append(pid)
+    rss[pid] = int(fields[21]) * pagesize
+  usage = {}
+  for pid in pids:
+    total, todo = 0, [pid]
+    while todo:
+      pid2 = todo.pop()
+      total += rss.get(pid2, 0)
+      todo.extend(children.get(pid2, []))
+    usage[pid] = total
+  return usage
+
+def index_trees(dxrconfig, trees, jobs, *args):
+  """ Indexes the trees, each one in a process of its own, with up to jobs of
+      them at a time. The worker processes configured in the DXR section are
+      shared between the trees that run at the same time. If the DXR section
+      sets a memory budget (in MB), a tree is only started while the trees
+      already running, plus the largest tree seen so far, stay below it.
+      Returns the names of the trees that failed. """
+  concurrency = max(1, min(jobs, len(trees)))
+  share = max(1, getworkers(dxrconfig) / concurrency)
+  try:
+    memory = int(dxrconfig.memory) * 2 ** 20
+  except AttributeError:
+    memory = None
+
+  pending = list(trees)
+  running = []
+  failed = []
+  peak = 0
+  while pending or running:
+    usage = get_rss([proc.pid for proc in running])
+    if usage:
+      peak = max(peak, max(usage.values()))
+    used = sum(usage.values())
+    while pending and len(running) < concurrency and \
+        (not running or memory is None or used + peak < memory):
+      treecfg = pending.pop(0)
+      treecfg.workers = str(min(getworkers(treecfg), share))
+      proc = Process(target=indextree, args=(treecfg,) + args,
+                     name=treecfg.tree)
+      proc.start()
+      running.append(proc)
+      used += peak
+    time.sleep(0.5)
+    for proc in list(running):
+      if not proc.is_alive():
+        proc.join()
+        running.remove(proc)
+        if proc.exitcode != 0:
+          print 'Indexing %s failed' % proc.name
+          failed.append(proc.name)
+  return failed
+
+def parseconfig(filename, doxref, dohtml, tree, debugfile, incremental, jobs):
   # Build the contents of an html <select> and open search links
   # for all trees encountered.
   # Note: id for CSS, name for form "get" value in query
@@ -387,6 +943,7 @@ def parseconfig(filename, doxref, dohtml, tree, debugfile):
 
   dxrconfig = dxr.load_config(filename)
 
+  trees = []
   for treecfg in dxrconfig.trees:
     # if tree is set, only index/build this section if it matches
     if tree and treecfg.tree != tree:
@@ -398,7 +955,10 @@ def parseconfig(filename, doxref, dohtml, tree, debugfile):
     opensearch += '<link rel="search" href="opensearch-' + treecfg.tree + '.xml" type="application/opensearchdescription+xml" '
     opensearch += 'title="' + treecfg.tree + '" />\n'
     WriteOpenSearch(treecfg.tree, treecfg.hosturl, treecfg.virtroot, treecfg.wwwdir)
-    indextree(treecfg, doxref, dohtml, debugfile)
+    trees.append(treecfg)
+
+  failed = index_trees(dxrconfig, trees, jobs, doxref, dohtml, debugfile,
+                       incremental)
 
   # Generate index page with drop-down + opensearch links for all trees
   indexhtml = dxrconfig.getTemplateFile('dxr-index-template.html')
@@ -414,6 +974,10 @@ def parseconfig(filename, doxref, dohtml, tree, debugfile):
   index.write(indexhtml)
   index.close()
 
+  if failed:
+    print 'Failed to index %s' % ', '.join(failed)
+    sys.exit(1)
+
 
 def main(argv):
   configfile = './dxr.config'
@@ -421,6 +985,8 @@ def main(argv):
   dohtml = True
   tree = None
   debugfile = None
+  incremental = False
+  jobs = 1
 
   try:
     if os.getenv("DXRSRC") is not None:
@@ -437,8 +1003,8 @@ def main(argv):
     sys.exit(2)
 
   try:
-    opts, args = getopt.getopt(argv, "hc:f:t:d:",
-        ["help", "create=", "file=", "tree=", "debug="])
+    opts, args = getopt.getopt(argv, "hic:f:t:d:j:",
+        ["help", "incremental", "create=", "file=", "tree=", "debug=", "jobs="])
   except getopt.GetoptError:
     usage()
     sys.exit(2)
@@ -458,8 +1024,16 @@ def main(argv):
       tree = o
     elif a in ('-d', '--debug'):
       debugfile = o
+    elif a in ('-i', '--incremental'):
+      incremental = True
+    elif a in ('-j', '--jobs'):
+      try:
+        jobs = max(1, int(o))
+      except ValueError:
+        usage()
+        sys.exit(2)
 
-  parseconfig(configfile, doxref, dohtml, tree, debugfile)
+  parseconfig(configfile, doxref, dohtml, tree, debugfile, incremental, jobs)
 
 if __name__ == '__main__':
   main(sys.argv[1:])
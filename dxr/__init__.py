@@ -1,10 +1,12 @@
 import marshal as cPickle
 from ConfigParser import ConfigParser
-from hashlib import sha1
 import dxr.languages
+import dxr.plugins
 import imp
+import mmap
 import os, sys
 import string
+import threading
 
 ###################
 # Plugin handling #
@@ -36,13 +38,19 @@ def get_active_plugins(tree=None, dxrsrc=None):
   return filter(plugin_filter, all_plugins)
 
 def load_plugins(dxrsrc=None):
+  """ Returns the plugins in xref-tools. Plugins with a plugin.ini manifest are
+      LazyPlugin objects, which only import the plugin when they have to. """
   if dxrsrc is None:
     dxrsrc = os.path.realpath(os.path.dirname(sys.argv[0]))
-  dirs = os.listdir(os.path.join(dxrsrc, 'xref-tools'))
+  # Sorted, since the plugins link their data in this order
+  dirs = sorted(os.listdir(os.path.join(dxrsrc, 'xref-tools')))
   all_plugins = []
   for dirname in dirs:
     fullname = os.path.join(dxrsrc, 'xref-tools', dirname)
     try:
+      if os.path.exists(os.path.join(fullname, 'plugin.ini')):
+        all_plugins.append(LazyPlugin(fullname))
+        continue
       m = imp.find_module('indexer', [fullname])
       module = imp.load_module('dxr.' + dirname, m[0], m[1], m[2])
       all_plugins.append(module)
@@ -52,42 +60,216 @@ def load_plugins(dxrsrc=None):
       pass
   return all_plugins
 
+def import_plugins(plugins):
+  """ Imports the modules of the given plugins now, instead of on first use """
+  for plugin in plugins:
+    if isinstance(plugin, LazyPlugin):
+      plugin._load()
+
+class LazyPlugin(object):
+  """ Stands in for the indexer module of a plugin, from the plugin.ini
+      manifest in its directory:
+        [plugin]
+        name = the name of the plugin; its module is dxr.<name>
+        file-endings = the file endings of its htmlifiers
+        exports = the __all__ of its module
+        can-use = yes or no, if the plugin can always or never be used
+        can-use-programs = programs that must be in the path
+        can-use-files = files that must exist in the source directory
+      The module is imported when anything else is asked for, or for can_use
+      if the manifest has no can-use hints. """
+  def __init__(self, plugindir):
+    config = ConfigParser()
+    config.read(os.path.join(plugindir, 'plugin.ini'))
+    manifest = dict(config.items('plugin'))
+    self.__name__ = 'dxr.' + manifest['name']
+    self.__file__ = os.path.join(plugindir, 'indexer.py')
+    self.__all__ = manifest.get('exports', '').split()
+    self.file_endings = manifest.get('file-endings', '').split()
+    self._plugindir = plugindir
+    self._hints = dict((key, manifest[key]) for key in
+                      ('can-use', 'can-use-programs', 'can-use-files')
+                      if key in manifest)
+    self._module = None
+    self._lock = threading.Lock()
+
+  def _load(self):
+    """ Imports the module of the plugin, once """
+    with self._lock:
+      if self._module is None:
+        m = imp.find_module('indexer', [self._plugindir])
+        try:
+          self._module = imp.load_module(self.__name__, m[0], m[1], m[2])
+        finally:
+          if m[0] is not None:
+            m[0].close()
+    return self._module
+
+  def __getattr__(self, name):
+    # Also keeps a half-built object from importing the module
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return getattr(self._load(), name)
+
+  def can_use(self, treecfg):
+    if not self._hints:
+      return self._load().can_use(treecfg)
+    if self._hints.get('can-use', 'yes') != 'yes':
+      return False
+    for program in self._hints.get('can-use-programs', '').split():
+      if not dxr.plugins.in_path(program):
+        return False
+    files = self._hints.get('can-use-files', '').split()
+    if files and treecfg is not None:
+      return any(os.path.exists(os.path.join(treecfg.sourcedir, f))
+                 for f in files)
+    return True
+
+# The plugin data of a tree is kept in three files in its .dxr_xref directory:
+#   index_blob.dat      the blobs without their "byfile" parts, and the
+#                       language data
+#   fileindex.dat       the data of all plugins for a source file, as one
+#                       marshalled {plugin: data} chunk per file
+#   fileindex_list.dat  the {plugin: [filename]} lists of the "byfile" parts,
+#                       and the {filename: (offset, length)} of the chunks
+# Pages only need the chunk of their own file, which FileChunks reads from a
+# memory map of fileindex.dat.
+blob_files = ['index_blob.dat', 'fileindex.dat', 'fileindex_list.dat']
+
 def store_big_blob(tree, blob, tmproot):
+  """ Writes the plugin data to tmproot, and returns the FileChunks of the
+      "byfile" parts of the blobs; see load_big_blob. """
   dbdir = os.path.join(tmproot, '.dxr_xref')
-  # Commented out code: serialize byfile stuff independently, to avoid memory
-  # wastage on very very large systems.
-  #byfile = {}
-  #filelist = set()
-  #for plug in blob:
-  #  try:
-  #    byfile[plug] = blob[plug].pop("byfile")
-  #    filelist.update(byfile[plug].keys())
-  #  except KeyError:
-  #    pass
-  f = open(os.path.join(dbdir, 'index_blob.dat'), 'wb')
+  # Serialize byfile stuff independently, to avoid memory wastage on very very
+  # large systems.
+  byfile = {}
+  filelist = set()
+  for plug in blob:
+    try:
+      byfile[plug] = blob[plug].pop("byfile")
+      filelist.update(byfile[plug].keys())
+    except (KeyError, AttributeError, TypeError):
+      pass
   try:
-    cPickle.dump((blob, dxr.languages.language_data), f, 2)
+    f = open(os.path.join(dbdir, 'index_blob.dat'), 'wb')
+    try:
+      cPickle.dump((blob, dxr.languages.dump_language_data()), f, 2)
+    finally:
+      f.close()
+    offsets = {}
+    f = open(os.path.join(dbdir, 'fileindex.dat'), 'wb')
+    try:
+      offset = 0
+      for fname in sorted(filelist):
+        fdir = dict((p, byfile[p][fname]) for p in byfile if fname in byfile[p])
+        chunk = cPickle.dumps(fdir, 2)
+        f.write(chunk)
+        offsets[fname] = (offset, len(chunk))
+        offset += len(chunk)
+    finally:
+      f.close()
+    f = open(os.path.join(dbdir, 'fileindex_list.dat'), 'wb')
+    try:
+      cPickle.dump((dict((p, byfile[p].keys()) for p in byfile), offsets), f, 2)
+    finally:
+      f.close()
   finally:
-    f.close()
-  #for fname in filelist:
-  #  datname = 'fileindex_%s.dat' % (sha1(fname).hexdigest())
-  #  f = open(os.path.join(dbdir, datname), 'wb')
-  #  fdir = dict((p, byfile[p][fname]) for p in byfile if fname in byfile[p])
-  #  try:
-  #    cPickle.dump(fdir, f, 2)
-  #  finally:
-  #    f.close()
-  #for plug in byfile:
-  #  blob[plug]["byfile"] = byfile[plug]
+    for plug in byfile:
+      blob[plug]["byfile"] = byfile[plug]
+  return FileChunks(dbdir, offsets)
 
 def load_big_blob(tree, tmproot):
+  """ Reads the plugin data written by store_big_blob. The "byfile" parts are
+      FileIndex objects, which only read the data of a file when asked for. """
   dbdir = os.path.join(tmproot, '.dxr_xref')
   f = open(os.path.join(dbdir, 'index_blob.dat'), 'rb')
   try:
-    big_blob, dxr.languages.language_data = cPickle.load(f)
-    return big_blob
+    big_blob, language_data = cPickle.load(f)
+  finally:
+    f.close()
+  dxr.languages.load_language_data(language_data)
+  f = open(os.path.join(dbdir, 'fileindex_list.dat'), 'rb')
+  try:
+    byfile, offsets = cPickle.load(f)
   finally:
     f.close()
+  chunks = FileChunks(dbdir, offsets)
+  for plug, names in byfile.iteritems():
+    big_blob[plug]["byfile"] = FileIndex(chunks, plug, names)
+  return big_blob
+
+def spill_big_blob(tree, blob, tmproot):
+  """ Stores the plugin data like store_big_blob, then replaces the "byfile"
+      parts of blob by FileIndex objects, so that they do not stay in memory.
+      Data that cannot be stored is kept as it is. """
+  try:
+    chunks = store_big_blob(tree, blob, tmproot)
+  except ValueError:
+    print 'Keeping plugin data in memory: %s' % sys.exc_info()[1]
+    return
+  for plug in blob:
+    try:
+      names = blob[plug]["byfile"].keys()
+    except (KeyError, AttributeError, TypeError):
+      continue
+    blob[plug]["byfile"] = FileIndex(chunks, plug, names)
+
+class FileChunks(object):
+  """ The chunks of fileindex.dat. The file is mapped into memory when the
+      first chunk is read, and only the bytes of the chunks asked for are
+      read from it. """
+  def __init__(self, dbdir, offsets):
+    self.path = os.path.join(dbdir, 'fileindex.dat')
+    self.offsets = offsets
+    self.map = None
+    # The htmlifiers of all plugins ask for the same file in turn
+    self.last = (None, None)
+
+  def read(self, fname):
+    """ Returns the {plugin: data} dictionary of the file """
+    if self.last[0] != fname:
+      offset, length = self.offsets[fname]
+      if self.map is None:
+        f = open(self.path, 'rb')
+        try:
+          self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+          f.close()
+      self.last = (fname, cPickle.loads(self.map[offset:offset + length]))
+    return self.last[1]
+
+class FileIndex(object):
+  """ The read-only {filename: data} "byfile" dictionary of a plugin, whose
+      values are read from FileChunks on demand. """
+  def __init__(self, chunks, plugin, names):
+    self.chunks = chunks
+    self.plugin = plugin
+    self.names = set(names)
+
+  def __getitem__(self, fname):
+    if fname not in self.names:
+      raise KeyError(fname)
+    return self.chunks.read(fname)[self.plugin]
+
+  def get(self, fname, default=None):
+    try:
+      return self[fname]
+    except KeyError:
+      return default
+
+  def __contains__(self, fname):
+    return fname in self.names
+
+  def __iter__(self):
+    return iter(self.names)
+
+  def __len__(self):
+    return len(self.names)
+
+  def keys(self):
+    return list(self.names)
+
+  iterkeys = __iter__
 
 class DxrConfig(object):
   def __init__(self, config, tree=None):
@@ -146,7 +328,7 @@ class DxrConfig(object):
         relpath = ''
       for f in files:
         # XXX: cxx-clang hack
-        if f.endswith(".csv"): continue
+        if f.endswith(".csv") or f.endswith(".dxrb"): continue
         relfname = os.path.join(relpath, f)
         if any([f == ex for ex in exclusions]):
           continue
@@ -172,5 +354,5 @@ def load_config(path=['/etc/dxr/dxr.config', './dxr.config']):
 
   return DxrConfig(config)
 
-__all__ = ['get_active_plugins', 'store_big_blob', 'load_big_blob',
-  'load_config', 'readFile']
+__all__ = ['get_active_plugins', 'import_plugins', 'store_big_blob', 'load_big_blob',
+  'spill_big_blob', 'blob_files', 'load_config', 'readFile']
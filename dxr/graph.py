@@ -0,0 +1,89 @@
+# Graph algorithms used by the plugins to compute transitive relations, such as
+# inheritance and method overrides. Graphs are {node: iterable of successors}
+# dictionaries; nodes may be any hashable value.
+
+def strongly_connected(graph):
+  """ Returns the strongly connected components of the graph as a list of
+      lists of nodes, using Tarjan's algorithm. Every component comes after
+      all of the components it has edges into, i.e. sinks come first. """
+  index = {}
+  lowlink = {}
+  onstack = set()
+  stack = []
+  components = []
+  counter = 0
+
+  nodes = set(graph)
+  for succs in graph.itervalues():
+    nodes.update(succs)
+
+  for root in nodes:
+    if root in index:
+      continue
+    # Iterative depth-first search, to not run into the recursion limit on
+    # long chains. Each frame is a node and an iterator over its successors.
+    index[root] = lowlink[root] = counter
+    counter += 1
+    stack.append(root)
+    onstack.add(root)
+    frames = [(root, iter(graph.get(root, ())))]
+    while frames:
+      node, succs = frames[-1]
+      for succ in succs:
+        if succ not in index:
+          index[succ] = lowlink[succ] = counter
+          counter += 1
+          stack.append(succ)
+          onstack.add(succ)
+          frames.append((succ, iter(graph.get(succ, ()))))
+          break
+        elif succ in onstack:
+          lowlink[node] = min(lowlink[node], index[succ])
+      else:
+        frames.pop()
+        if frames:
+          parent = frames[-1][0]
+          lowlink[parent] = min(lowlink[parent], lowlink[node])
+        if lowlink[node] == index[node]:
+          component = []
+          while True:
+            member = stack.pop()
+            onstack.discard(member)
+            component.append(member)
+            if member == node:
+              break
+          components.append(component)
+  return components
+
+def reachable(graph):
+  """ Returns a {node: set of nodes} dictionary with, for every node of the
+      graph, the nodes that can be reached from it through one or more edges.
+      A node only reaches itself if it is on a cycle.
+
+      The graph is condensed into its strongly connected components first, and
+      the components are then swept sinks first, so that each set is the
+      union of the sets of its successors. All nodes of a component share the
+      same set, so the sets must not be modified. """
+  components = strongly_connected(graph)
+  component_of = {}
+  for i, component in enumerate(components):
+    for node in component:
+      component_of[node] = i
+
+  reach = [None] * len(components)
+  for i, component in enumerate(components):
+    result = set()
+    cyclic = len(component) > 1
+    for node in component:
+      for succ in graph.get(node, ()):
+        j = component_of[succ]
+        if j == i:
+          cyclic = True
+        elif succ not in result:
+          result.add(succ)
+          result |= reach[j]
+    if cyclic:
+      result.update(component)
+    reach[i] = result
+
+  return dict((node, reach[component_of[node]]) for node in component_of)
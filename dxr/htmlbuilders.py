@@ -85,8 +85,11 @@ class HtmlBuilder:
     html+=('</div>')
     return html
 
-  def toHTML(self, inhibit_sidebar):
-    out = open(self.dstpath, 'w')
+  def toHTML(self, inhibit_sidebar, out=None):
+    """ Writes the page to out, or to dstpath if out is None """
+    opened = out is None
+    if opened:
+      out = open(self.dstpath, 'w')
     sidebarActions = self.getSidebarActions()
     self.html_header = self.html_header.replace('${sidebarActions}', sidebarActions);
 
@@ -101,7 +104,8 @@ class HtmlBuilder:
     self.writeMainContent(out)
     self.writeGlobalScript(out)
     out.write(self.html_footer + '\n')
-    out.close()
+    if opened:
+      out.close()
 
   def writeSidebar(self, out):
     sidebarElements = [x for x in self._zipper("get_sidebar_links")]
@@ -225,36 +229,49 @@ class HtmlBuilder:
 htmlifier_map = {}
 ending_iterator = []
 inhibit_sidebar = {}
+# The plugins whose htmlifiers for an ending are not in the map yet, in order;
+# see resolve_htmlifiers
+pending_htmlifiers = {}
+
+def add_to_map(ending, hmap, pluginname, append):
+  for x in ['get_sidebar_links', 'get_link_regions', 'get_line_annotations',
+      'get_syntax_regions']:
+    if x not in hmap:
+      continue
+    details = htmlifier_map[ending].setdefault(x, [None])
+    if append:
+      details.append((pluginname, hmap[x]))
+    else:
+      details[0] = (pluginname, hmap[x])
 
-def build_htmlifier_map(plugins):
-  def add_to_map(ending, hmap, pluginname, append):
-    for x in ['get_sidebar_links', 'get_link_regions', 'get_line_annotations',
-        'get_syntax_regions']:
-      if x not in hmap:
-        continue
-      details = htmlifier_map[ending].setdefault(x, [None])
-      if append:
-        details.append((pluginname, hmap[x]))
-      else:
-        details[0] = (pluginname, hmap[x])
-
-    if 'get_inhibit_sidebar' in hmap and hmap['get_inhibit_sidebar'] is True:
-      inhibit_sidebar[ending] = True
+  if 'get_inhibit_sidebar' in hmap and hmap['get_inhibit_sidebar'] is True:
+    inhibit_sidebar[ending] = True
 
-  # Add/append details for each map
+def build_htmlifier_map(plugins):
+  # Add/append details for each map. Plugins with a manifest name their file
+  # endings there, and are only imported once a file with one of them is built.
   for plug in plugins:
-    plug_map = plug.get_htmlifiers()
-    for ending in plug_map:
+    endings = getattr(plug, 'file_endings', None)
+    if endings is None:
+      endings = plug.get_htmlifiers().keys()
+    for ending in endings:
       if ending not in htmlifier_map:
         ending_iterator.append(ending)
         htmlifier_map[ending] = {}
-      nosquash = 'no-override' in plug_map[ending]
-      add_to_map(ending, plug_map[ending], plug.__name__, nosquash)
+      pending_htmlifiers.setdefault(ending, []).append(plug)
   # Sort the endings by maximum length, so that we can just find the first one
   # in the list
   ending_iterator.sort(lambda x, y: cmp(len(y), len(x)))
 
-def make_html(srcpath, dstfile, treecfg, blob, conn = None):
+def resolve_htmlifiers(ending):
+  """ Adds the htmlifiers of the plugins for the ending to the map """
+  for plug in pending_htmlifiers.pop(ending, []):
+    plug_map = plug.get_htmlifiers()
+    if ending in plug_map:
+      nosquash = 'no-override' in plug_map[ending]
+      add_to_map(ending, plug_map[ending], plug.__name__, nosquash)
+
+def make_html(srcpath, dstfile, treecfg, blob, conn = None, out = None):
   # Match the file in srcpath
   result_map = {}
   signalStop = False
@@ -262,6 +279,7 @@ def make_html(srcpath, dstfile, treecfg, blob, conn = None):
 
   for end in ending_iterator:
     if srcpath.endswith(end):
+      resolve_htmlifiers(end)
       for func in htmlifier_map[end]:
         reslist = result_map.setdefault(func, [None])
         flist = htmlifier_map[end][func]
@@ -274,4 +292,4 @@ def make_html(srcpath, dstfile, treecfg, blob, conn = None):
     if signalStop:
       break
   builder = HtmlBuilder(treecfg, srcpath, dstfile, blob, result_map, conn)
-  builder.toHTML(inhibit)
+  builder.toHTML(inhibit, out)
@@ -19,7 +19,8 @@ language_schema = dxr.plugins.Schema({
     ("sname", "VARCHAR(256)", True),  # Name of the scope
     ("language", "_language", False), # The language of the scope
     ("_location", True),
-    ("_key", "scopeid")
+    ("_key", "scopeid"),
+    ("_sequenced",)
   ],
   # Type definitions: anything that defines a type per the relevant specs.
   "types": [
@@ -33,8 +34,10 @@ language_schema = dxr.plugins.Schema({
     ("extent_end", "INTEGER", True),
     ("_location", True),
     ("_key", "tid"),
-    ("_fkey", "scopeid", "scopes", "scopeid")
-#    ("_index", "tqualname", "tloc")
+    ("_sequenced",),
+    ("_fkey", "scopeid", "scopes", "scopeid"),
+    ("_lookup", "scope", "scopeid", "tid"),
+    ("_lookup", "name", "tname")
   ],
   # Inheritance relations: note that we store the full transitive closure in
   # this table, so if A extends B and B extends C, we'd have (A, C) stored in
@@ -44,7 +47,8 @@ language_schema = dxr.plugins.Schema({
     ("tbase", "INTEGER", False),      # tid of base type
     ("tderived", "INTEGER", False),   # tid of derived type
     ("inhtype", "VARCHAR(32)", True), # Type of inheritance; NULL is indirect
-    ("_key", "tbase", "tderived")
+    ("_key", "tbase", "tderived"),
+    ("_lookup", "derived", "tderived", "tbase", "inhtype")
   ],
   # Functions: functions, methods, constructors, operator overloads, etc.
   "functions": [
@@ -60,8 +64,11 @@ language_schema = dxr.plugins.Schema({
     ("extent_end", "INTEGER", True),
     ("_location", True),
     ("_key", "funcid"),
+    ("_sequenced",),
     ("_fkey", "scopeid", "scopes", "scopeid"),
-#    ("_index", "fqualname", "floc")
+    ("_lookup", "scope", "scopeid", "funcid"),
+    ("_lookup", "name", "fname", "funcid"),
+    ("_lookup", "qualname", "fqualname")
   ],
   # Variables: class, global, local, enum constants; they're all in here
   # Variables are of course not scopes, but for ease of use, they use IDs from
@@ -77,8 +84,10 @@ language_schema = dxr.plugins.Schema({
     ("extent_end", "INTEGER", True),
     ("_location", True),
     ("_key", "varid"),
+    ("_sequenced",),
     ("_fkey", "scopeid", "scopes", "scopeid"),
-#    ("_index", "vname", "vloc")
+    ("_lookup", "scope", "scopeid", "varid"),
+    ("_lookup", "name", "vname")
   ],
   "crosslang": [
     ("canonid", "INTEGER", False),
@@ -86,6 +95,10 @@ language_schema = dxr.plugins.Schema({
     ("otherlanguage", "VARCHAR(32)", False),
     ("_key", "otherid")
   ],
+  # The highest ID that has been handed out; see dxr.plugins.reserve_ids
+  "global_ids": [
+    ("last_id", "INTEGER", False)
+  ],
 })
 
 # Build the blob for the language data
@@ -105,19 +118,47 @@ for table in language_data:
 
 def get_standard_schema():
   ''' Returns the standard schema for multiple language support. '''
-  return language_schema.get_create_sql()
+  # The files are looked up by path while the database is being filled, so
+  # their index has to be there from the start.
+  return (language_schema.get_create_sql() +
+          language_schema.get_index_sql(['files']) +
+          'INSERT INTO global_ids (last_id) VALUES (0);\n')
 
 def register_language_table(language, tablename, table):
-  ''' Add the rows in the table to the language schema. '''
+  ''' Add the rows in the table to the language schema. They are kept as
+      records of the table; see SchemaTable.get_row. '''
   tableit = isinstance(table, dict) and table.itervalues() or table
   dest = language_data[tablename]
+  get_row = language_schema.tables[tablename].get_row
   key = tableids.get(tablename, None)
   if key is not None:
     for row in tableit:
       row["language"] = language
-      dest[row[key]] = row
+      dest[row[key]] = get_row(row)
   else:
-    dest.extend(tableit)
+    dest.extend(get_row(row) for row in tableit)
+
+def dump_language_data():
+  ''' Returns language_data with plain tuples for the records, which marshal
+      can store. '''
+  data = {}
+  for tablename, table in language_data.iteritems():
+    if isinstance(table, dict):
+      data[tablename] = dict((key, tuple(row)) for key, row in table.iteritems())
+    else:
+      data[tablename] = [tuple(row) for row in table]
+  return data
+
+def load_language_data(data):
+  ''' Sets language_data from the result of dump_language_data. '''
+  global language_data
+  for tablename, table in data.iteritems():
+    make = language_schema.tables[tablename].row_class._make
+    if isinstance(table, dict):
+      data[tablename] = dict((key, make(row)) for key, row in table.iteritems())
+    else:
+      data[tablename] = [make(row) for row in table]
+  language_data = data
 
 def get_row_for_id(table, key, canonical=False):
   ''' Retrieves the row for the given id and language. If the key is not found,
@@ -0,0 +1,91 @@
+import dxr.mime
+import os
+from hashlib import sha1
+
+# The manifest records the size, mtime and content hash of every file that was
+# indexed, as well as whether it is a text file. It is written next to
+# file_list.txt, so that the next run can find out which files changed without
+# having to re-read or re-classify the whole tree.
+#
+# The on-disk format is one line per file: "sha1 size mtime text path", where
+# text is 1 or 0. The path comes last so that it may contain spaces.
+
+manifest_name = 'file_manifest.txt'
+
+def hash_file(path):
+  """ Returns the hex sha1 of the contents of path. """
+  digest = sha1()
+  f = open(path, 'rb')
+  try:
+    while True:
+      data = f.read(1 << 16)
+      if not data:
+        break
+      digest.update(data)
+  finally:
+    f.close()
+  return digest.hexdigest()
+
+def make_entry(path, old=None):
+  """ Returns the manifest entry for the file at path. If the entry from the
+      previous manifest has the same size and mtime, its hash is reused instead
+      of reading the file again, and the file is only classified if its
+      contents changed. """
+  st = os.stat(path)
+  if old is not None and old['size'] == st.st_size and \
+      old['mtime'] == st.st_mtime:
+    digest = old['sha1']
+  else:
+    digest = hash_file(path)
+  if old is not None and old['sha1'] == digest:
+    text = old['text']
+  else:
+    text = dxr.mime.is_text(path)
+  return {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': digest,
+          'text': text}
+
+def load_manifest(dbdir):
+  """ Returns the manifest stored in dbdir as a {relpath: entry} dictionary.
+      A missing or unreadable manifest results in an empty dictionary. """
+  manifest = {}
+  try:
+    f = open(os.path.join(dbdir, manifest_name))
+  except IOError:
+    return manifest
+  try:
+    for line in f:
+      digest, size, mtime, text, path = line.rstrip('\n').split(' ', 4)
+      manifest[path] = {'size': int(size), 'mtime': float(mtime),
+                        'sha1': digest, 'text': bool(int(text))}
+  except ValueError:
+    print 'Ignoring corrupt manifest in %s' % dbdir
+    return {}
+  finally:
+    f.close()
+  return manifest
+
+def store_manifest(dbdir, manifest):
+  """ Writes the {relpath: entry} manifest into dbdir. """
+  f = open(os.path.join(dbdir, manifest_name), 'w')
+  try:
+    for path in sorted(manifest):
+      entry = manifest[path]
+      f.write('%s %d %r %d %s\n' % (entry['sha1'], entry['size'],
+                                    entry['mtime'], entry['text'], path))
+  finally:
+    f.close()
+
+def diff_manifests(old, new):
+  """ Compares two manifests and returns an (added, changed, removed,
+      unchanged) tuple of sets of relative paths. """
+  added, changed, unchanged = set(), set(), set()
+  for path, entry in new.iteritems():
+    prev = old.get(path)
+    if prev is None:
+      added.add(path)
+    elif prev['sha1'] != entry['sha1']:
+      changed.add(path)
+    else:
+      unchanged.add(path)
+  removed = set(old).difference(new)
+  return added, changed, removed, unchanged
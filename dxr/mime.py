@@ -0,0 +1,79 @@
+import os
+
+# Tells text files (which get an HTML page) apart from binary files. Most files
+# are decided by their name alone; everything else gets its first few KB
+# sniffed for null bytes and invalid UTF-8.
+
+text_extensions = set([
+  '.c', '.cc', '.cpp', '.cxx', '.h', '.hh', '.hpp', '.hxx', '.inl', '.tcc',
+  '.m', '.mm', '.s', '.asm', '.y', '.l', '.def', '.inc', '.tbl', '.msg',
+  '.idl', '.webidl', '.ipdl', '.ipdlh', '.java', '.rs', '.go', '.cs',
+  '.js', '.jsm', '.jsx', '.ts', '.json', '.py', '.pl', '.pm', '.rb', '.php',
+  '.sh', '.bash', '.zsh', '.csh', '.bat', '.cmd', '.ps1', '.cgi', '.awk',
+  '.sed', '.tcl', '.lua', '.sql', '.m4', '.mk', '.in', '.ac', '.am',
+  '.cmake', '.gyp', '.gypi', '.build', '.mozbuild', '.configure',
+  '.html', '.htm', '.xhtml', '.xml', '.xul', '.xbl', '.xsl', '.xslt', '.rdf',
+  '.dtd', '.svg', '.css', '.txt', '.text', '.md', '.rst', '.tex', '.diff',
+  '.patch', '.ini', '.cfg', '.conf', '.properties', '.manifest', '.mn',
+  '.list', '.yaml', '.yml', '.toml', '.po', '.pot', '.rc', '.vim', '.el',
+])
+
+binary_extensions = set([
+  # xdg.Mime considers .lo as text, which is technically true but useless
+  '.lo', '.la', '.o', '.obj', '.a', '.lib', '.so', '.dylib', '.dll', '.exe',
+  '.pdb', '.pyc', '.pyo', '.class', '.jar', '.xpi', '.xpt', '.mar', '.zip',
+  '.gz', '.tgz', '.bz2', '.xz', '.7z', '.tar', '.rar', '.png', '.gif', '.jpg',
+  '.jpeg', '.ico', '.icns', '.bmp', '.tif', '.tiff', '.webp', '.psd', '.ttf',
+  '.otf', '.woff', '.woff2', '.eot', '.pdf', '.mp3', '.ogg', '.oga', '.ogv',
+  '.wav', '.mp4', '.webm', '.swf', '.sqlite', '.db', '.bin',
+])
+
+text_basenames = set([
+  'Makefile', 'makefile', 'GNUmakefile', 'README', 'LICENSE', 'COPYING',
+  'AUTHORS', 'CHANGES', 'ChangeLog', 'INSTALL', 'NEWS', 'TODO', 'configure',
+  'mozconfig', 'Doxyfile', 'Dockerfile', 'Vagrantfile', 'Rakefile',
+  'Gemfile', 'SConstruct', 'SConscript', 'CMakeLists.txt',
+])
+
+# How much of a file the sniffer looks at
+sniff_size = 4096
+
+def classify_name(path):
+  """ Returns True or False if the name of the file decides whether it is
+      text, and None if the contents have to be looked at. """
+  basename = os.path.basename(path)
+  if basename in text_basenames:
+    return True
+  ext = os.path.splitext(basename)[1].lower()
+  if ext in text_extensions:
+    return True
+  if ext in binary_extensions:
+    return False
+  return None
+
+def sniff(data):
+  """ Returns whether the (possibly truncated) contents look like text. """
+  if '\0' in data:
+    return False
+  try:
+    data.decode('utf-8')
+    return True
+  except UnicodeDecodeError, e:
+    # A multibyte sequence cut off by the sniff size is fine
+    if e.start >= len(data) - 3 and e.reason == 'unexpected end of data':
+      return True
+  # Not UTF-8; accept legacy 8-bit encodings unless there is a lot of control
+  # characters in there.
+  control = sum(1 for c in data if c < ' ' and c not in '\t\n\r\f\b\x1b')
+  return control * 10 < len(data)
+
+def is_text(path):
+  """ Returns whether the file at path is a text file. """
+  decision = classify_name(path)
+  if decision is not None:
+    return decision
+  f = open(path, 'rb')
+  try:
+    return sniff(f.read(sniff_size))
+  finally:
+    f.close()
@@ -0,0 +1,97 @@
+import errno
+import os
+import shutil
+import tempfile
+from hashlib import sha1
+
+# A content-addressed store for the generated pages. Every page is written once
+# into the store, under the sha1 of its contents, and the generations link to
+# it. Pages that did not change between two runs are thus stored only once, and
+# removing an old generation only drops links. Because of that, a page must
+# never be modified in place once it has been stored.
+#
+# The store lives in the wwwdir, so that it is on the same file system as the
+# generations. Objects that no generation links to any more are removed by
+# collect().
+
+store_name = '.dxr_objects'
+
+def get_store(wwwdir):
+  """ Returns the path of the object store for wwwdir, creating it if needed. """
+  store = os.path.join(wwwdir, store_name)
+  makedirs(store)
+  return store
+
+def makedirs(path):
+  try:
+    os.makedirs(path)
+  except OSError, e:
+    if e.errno != errno.EEXIST:
+      raise
+
+def object_path(store, digest):
+  return os.path.join(store, digest[:2], digest[2:])
+
+def write_object(store, digest, data):
+  """ Atomically writes data as the object digest """
+  objpath = object_path(store, digest)
+  makedirs(os.path.dirname(objpath))
+  fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(objpath), prefix='.tmp')
+  try:
+    os.write(fd, data)
+  finally:
+    os.close(fd)
+  os.chmod(tmppath, 0644)
+  os.rename(tmppath, objpath)
+  return objpath
+
+def put(store, data, dstpath):
+  """ Makes dstpath a link to the object holding data, writing the object only
+      if it is not in the store yet. Returns whether the object was new. """
+  digest = sha1(data).hexdigest()
+  objpath = object_path(store, digest)
+  new = not os.path.exists(objpath)
+  if new:
+    write_object(store, digest, data)
+  try:
+    os.link(objpath, dstpath)
+  except OSError, e:
+    if e.errno == errno.ENOENT:
+      # Collected by another tree in the meantime
+      os.link(write_object(store, digest, data), dstpath)
+      return True
+    # No hard links here, or too many of them: keep a plain copy
+    f = open(dstpath, 'wb')
+    try:
+      f.write(data)
+    finally:
+      f.close()
+  return new
+
+def link_or_copy(srcpath, dstpath):
+  """ Links dstpath to the same file as srcpath, copying it if that fails. """
+  try:
+    os.link(srcpath, dstpath)
+  except OSError:
+    shutil.copyfile(srcpath, dstpath)
+
+def collect(store):
+  """ Removes the objects that no generation links to any more. Returns the
+      number of objects removed. """
+  removed = 0
+  for subdir in os.listdir(store):
+    subpath = os.path.join(store, subdir)
+    if not os.path.isdir(subpath):
+      continue
+    for name in os.listdir(subpath):
+      # Objects that are being written
+      if name.startswith('.tmp'):
+        continue
+      objpath = os.path.join(subpath, name)
+      try:
+        if os.lstat(objpath).st_nlink == 1:
+          os.unlink(objpath)
+          removed += 1
+      except OSError:
+        pass
+  return removed
@@ -0,0 +1,127 @@
+import sys
+import threading
+import time
+
+class Stage(object):
+  """ A named unit of work in a Pipeline. The function takes no arguments and
+      may return the number of items it processed, for throughput reports. """
+  def __init__(self, name, func, deps):
+    self.name = name
+    self.func = func
+    self.deps = deps
+    self.start = None
+    self.end = None
+    self.items = None
+    self.error = None
+
+  def run(self, watch=None):
+    self.start = time.time()
+    try:
+      if watch is None:
+        self.items = self.func()
+      else:
+        with watch.span(self.name, 'stage'):
+          self.items = self.func()
+          if self.items is not None:
+            watch.count('items', self.items, total=False)
+    except:
+      self.error = sys.exc_info()
+    self.end = time.time()
+
+class Pipeline(object):
+  """ Runs stages concurrently, each one as soon as all of the stages it depends
+      on have finished.
+
+      Stages run in threads of this process; stages that need real parallelism
+      are expected to spread their work over a process pool themselves. If a
+      stage fails, the stages depending on it are skipped, and once everything
+      else has finished, run() re-raises the error of the first failed stage.
+      If a StopWatch is given, every stage is timed as a span of kind 'stage',
+      below the span that is open when run() is called. """
+  def __init__(self, name, watch=None):
+    self.name = name
+    self.watch = watch
+    self.stages = []
+    self.byname = {}
+
+  def add_stage(self, name, func, deps=()):
+    for dep in deps:
+      if dep not in self.byname:
+        raise ValueError('Stage %s depends on unknown stage %s' % (name, dep))
+    stage = Stage(name, func, list(deps))
+    self.stages.append(stage)
+    self.byname[name] = stage
+    return stage
+
+  def run(self):
+    cond = threading.Condition()
+    pending = list(self.stages)
+    running = []
+    done, failed = set(), set()
+    threads = []
+    self.start = time.time()
+    parent = self.watch is not None and self.watch.current() or None
+
+    def runner(stage):
+      if self.watch is None:
+        stage.run()
+      else:
+        with self.watch.within(parent):
+          stage.run(self.watch)
+      cond.acquire()
+      try:
+        running.remove(stage)
+        if stage.error is None:
+          done.add(stage.name)
+          print '%s: finished %s in %.1fs' % (self.name, stage.name,
+                                               stage.end - stage.start)
+        else:
+          failed.add(stage.name)
+          if not issubclass(stage.error[0], SystemExit):
+            print '%s: stage %s failed:' % (self.name, stage.name)
+            sys.excepthook(*stage.error)
+        cond.notify()
+      finally:
+        cond.release()
+
+    cond.acquire()
+    try:
+      while pending or running:
+        for stage in list(pending):
+          if any(dep in failed for dep in stage.deps):
+            print '%s: skipping %s' % (self.name, stage.name)
+            failed.add(stage.name)
+            pending.remove(stage)
+          elif all(dep in done for dep in stage.deps):
+            print '%s: starting %s' % (self.name, stage.name)
+            pending.remove(stage)
+            running.append(stage)
+            thread = threading.Thread(target=runner, args=(stage,),
+                                      name='%s-%s' % (self.name, stage.name))
+            threads.append(thread)
+            thread.start()
+        if running:
+          cond.wait()
+    finally:
+      cond.release()
+    for thread in threads:
+      thread.join()
+    self.end = time.time()
+
+    self.report()
+    for stage in self.stages:
+      if stage.error is not None:
+        raise stage.error[0], stage.error[1], stage.error[2]
+
+  def report(self):
+    """ Prints the start, end and throughput of every stage that ran. """
+    print '%s: %.1fs total' % (self.name, self.end - self.start)
+    for stage in self.stages:
+      if stage.start is None:
+        continue
+      line = '  %-12s %8.1fs .. %8.1fs' % (stage.name, stage.start - self.start,
+                                          stage.end - self.start)
+      if stage.items is not None:
+        duration = max(stage.end - stage.start, 1e-6)
+        line += '  %d items, %.1f/s' % (stage.items, stage.items / duration)
+      print line
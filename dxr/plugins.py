@@ -1,5 +1,9 @@
+from collections import namedtuple
+from itertools import count
+from multiprocessing import cpu_count, Pool
 import dxr.languages
 import os
+import threading
 
 def in_path(exe):
   """ Returns true if the executable can be found in the given path.
@@ -32,6 +36,36 @@ def default_pre_html_process(treecfg, blob):
   """ Called immediately before htmlifiers are first run. """
   return True
 
+def default_build_indexes(conn, lookups=True):
+  """ Creates the indexes of the tables of get_schema, which are filled without
+      them. Called once the build_database of all plugins is done, first with
+      lookups False for the unique indexes, which also remove the duplicate
+      rows, and again after link_database for all of them. It must only build
+      the indexes that are missing. """
+  pass
+
+def default_link_database(conn, srcdir, objdir, cache=None):
+  """ Works on the rows of all plugins, once they are in the database and
+      their duplicates are gone; see build_indexes. Runs after the
+      link_database of the plugins before it. """
+  pass
+
+def default_get_table_access():
+  """ Returns (reads, writes), the names of the tables that build_database
+      reads and writes. The build_database of plugins whose tables do not
+      conflict run concurrently; the others run in the order of the plugins.
+      None, the default, stands for any table. """
+  return None
+
+def tables_conflict(access, other):
+  """ Returns True if the build_database of plugins with the given
+      get_table_access results must not run at the same time. """
+  if access is None or other is None:
+    return True
+  reads, writes = map(set, access)
+  other_reads, other_writes = map(set, other)
+  return bool(writes & (other_reads | other_writes) or other_writes & reads)
+
 def default_get_htmlifiers():
   """ Returns source code htmlifiers that this plugin uses.
       
@@ -98,12 +132,43 @@ class Schema:
       self.tables[tbl] = SchemaTable(tbl, schema[tbl])
 
   def get_create_sql(self):
-    """ Returns the SQL that creates the tables in this schema. """
+    """ Returns the SQL that creates the tables in this schema, without their
+        indexes; see build_indexes. """
     return '\n'.join([tbl.get_create_sql() for tbl in self.tables.itervalues()])
 
+  def get_index_sql(self, tables=None, lookups=True):
+    """ Returns the SQL that removes the duplicates from the given tables (all
+        of them by default) and creates their indexes. """
+    if tables is None:
+      tables = self.tables.iterkeys()
+    return '\n'.join([self.tables[tbl].get_index_sql(lookups) for tbl in tables])
+
+  def build_indexes(self, conn, lookups=True):
+    """ Removes the duplicates from the tables and creates the indexes that do
+        not exist yet. Tables are filled without indexes, which is a lot faster
+        than updating them with every row, and the rows that the unique indexes
+        would have ignored are removed here, in one pass per index. The _lookup
+        indexes are only needed by the queries on the final database, and are
+        left out if lookups is False. """
+    existing = set(row[0] for row in
+                   conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+    for tbl in self.tables.itervalues():
+      for name, statements in tbl.get_indexes(lookups):
+        # Not executescript: other stages may change the schema meanwhile, and
+        # only execute prepares the statements again when that happens
+        if name not in existing:
+          for sql in statements:
+            conn.execute(sql)
+
   def get_insert_sql(self, tblname, args):
     return self.tables[tblname].get_insert_sql(args)
 
+  def insert_rows(self, conn, tblname, rows):
+    self.tables[tblname].insert_rows(conn, rows)
+
+  def get_row(self, tblname, args):
+    return self.tables[tblname].get_row(args)
+
   def get_data_sql(self, blob):
     """ Returns the SQL that inserts data into tables given a blob. """
     for tbl in self.tables:
@@ -127,6 +192,14 @@ class SchemaTable:
       
       Any column name that begins with a `_' is metadata about the table:
         _key: the result tuple is a tuple for the primary key of the table.
+        _index: the columns of a unique index on the table.
+        _lookup: a (name, col, ...) tuple for a non-unique index on the columns,
+          for the queries that are run on the database. A table may have
+          several of them; the best ones cover all of the columns a query reads.
+        _sequenced: the rows are numbered in an insertseq column as they are
+          inserted through insert_rows or get_insert_sql, so that the unique
+          indexes keep the first row inserted. Needed by the tables whose
+          primary key is an ID handed out by next_global_id.
 
       Special values for type strings are as follows:
         _location: A file:loc[:col] value for the column.
@@ -142,10 +215,12 @@ class SchemaTable:
     self.name = tblname
     self.key = None
     self.index = None
+    self.lookups = []
     self.fkeys = []
     self.columns = []
     self.needLang = False
     self.needFileKey = False
+    self.sequenced = False
     defaults = ['VARCHAR(256)', True]
     for col in tblschema:
       if isinstance(tblschema, tuple) or isinstance(tblschema, list):
@@ -160,6 +235,10 @@ class SchemaTable:
         self.fkeys.append(spec)
       elif col == '_index':
         self.index = spec
+      elif col == '_sequenced':
+        self.sequenced = True
+      elif col == '_lookup':
+        self.lookups.append((spec[0], spec[1:]))
       elif col == '_location':
         if len(spec) <= 1:
           prefix = ''
@@ -177,6 +256,17 @@ class SchemaTable:
           values.extend(defaults[len(spec):])
         self.columns.append((col, spec))
 
+    # Rows for insert_rows are records of row_class: tuples of the values in
+    # this order, which can also be read by column name
+    self.colnames = [col for col, spec in self.columns]
+    self.row_class = namedtuple(tblname, self.colnames)
+
+    inserted = list(self.colnames)
+    if self.sequenced:
+      inserted.append('insertseq')
+    self.insert_sql = 'INSERT OR IGNORE INTO %s (%s) VALUES (%s)' % (self.name,
+      ','.join(inserted), ','.join('?' for col in inserted))
+
   def get_create_sql(self):
     sql = 'DROP TABLE IF EXISTS %s;\n' % (self.name)
     sql += 'CREATE TABLE %s (\n  ' % (self.name)
@@ -193,6 +283,8 @@ class SchemaTable:
       if len(spec) > 1 and spec[1] == False:
         specsql += ' NOT NULL'
       colstrs.append(specsql)
+    if self.sequenced:
+      colstrs.append('insertseq INTEGER')
 
     if self.needFileKey is True:
       colstrs.append('FOREIGN KEY (file_id) REFERENCES files(ID)')
@@ -203,37 +295,104 @@ class SchemaTable:
       colstrs.append('PRIMARY KEY (%s)' % ', '.join(self.key))
     sql += ',\n  '.join(colstrs)
     sql += '\n);\n'
+    return sql
+
+  def get_indexes(self, lookups=True):
+    """ Returns the (name, statements) of the indexes of the table, the unique
+        ones first. Their statements first remove the rows that would violate
+        the index, keeping the first one inserted, like INSERT OR IGNORE would
+        have. """
+    indexes = []
     if self.index is not None:
-      sql += 'CREATE UNIQUE INDEX %s_index on %s (%s);\n' % (self.name, self.name, ','.join(self.index))
+      indexes.append(('%s_index' % self.name, self.index))
     if self.needFileKey is True:
-      sql += 'CREATE UNIQUE INDEX %s_file_index on %s (file_id, file_line, file_col);' % (self.name, self.name)
-    return sql
+      indexes.append(('%s_file_index' % self.name, ('file_id', 'file_line', 'file_col')))
+
+    if self.sequenced:
+      # The rowid of the row with the smallest insertseq of each group
+      first = 'SELECT rowid FROM (SELECT rowid, MIN(insertseq) FROM %s GROUP BY %s)'
+    else:
+      first = 'SELECT MIN(rowid) FROM %s GROUP BY %s'
+    result = []
+    for name, cols in indexes:
+      # NULLs are never equal to each other in a unique index
+      dedup = 'DELETE FROM %s WHERE rowid NOT IN (%s)' % (
+        self.name, first % (self.name, ','.join(cols)))
+      dedup += ''.join(' AND %s IS NOT NULL' % col for col in cols)
+      create = 'CREATE UNIQUE INDEX IF NOT EXISTS %s on %s (%s)' % (name, self.name, ','.join(cols))
+      result.append((name, [dedup, create]))
+
+    if lookups:
+      for name, cols in self.lookups:
+        name = '%s_%s_lookup' % (self.name, name)
+        result.append((name, ['CREATE INDEX IF NOT EXISTS %s on %s (%s)' % (
+          name, self.name, ','.join(cols))]))
+    return result
+
+  def get_index_sql(self, lookups=True):
+    return ''.join([';\n'.join(statements) + ';\n' for name, statements in self.get_indexes(lookups)])
 
   def get_data_sql(self, blobtbl):
     it = isinstance(blobtbl, dict) and blobtbl.itervalues() or blobtbl
-    colset = set(col[0] for col in self.columns)
     for row in it:
-      # Only add the keys in the columns
-      keys = colset.intersection(row.iterkeys())
-      args = tuple(row[k] for k in keys)
-      yield ('INSERT OR IGNORE INTO %s (%s) VALUES (%s);' % (self.name,
-        ','.join(keys), ','.join('?' for k in keys)), args)
+      yield self.get_insert_sql(row)
 
   def get_insert_sql(self, args):
-    colset = set(col[0] for col in self.columns)
-    unwanted = []
-
-    # Only add the keys in the columns
-    for key in args.iterkeys():
-      if key not in colset:
-        unwanted.append(key)
-
-    for key in unwanted:
-      del args[key]
-
-    return ('INSERT OR IGNORE INTO %s (%s) VALUES (%s)' %
-            (self.name, ','.join(args.keys()), ','.join('?' for k in range(0, len(args)))),
-            args.values())
+    row = self.get_row(args)
+    if self.sequenced:
+      row += (insert_sequence.next(),)
+    return (self.insert_sql, row)
+
+  def insert_rows(self, conn, rows):
+    """ Inserts rows made by get_row, all with the same statement, so that
+        sqlite only has to prepare it once. Rows of this table must only be
+        inserted through here or get_insert_sql, which number them. """
+    if self.sequenced:
+      rows = (row + (insert_sequence.next(),) for row in rows)
+    conn.executemany(self.insert_sql, rows)
+
+  def get_row(self, args):
+    """ Returns the record of row_class for args, a {col: value} dictionary or
+        a record already. Missing columns are NULL, other keys are ignored. """
+    if isinstance(args, self.row_class):
+      return args
+    return tuple.__new__(self.row_class, map(args.get, self.colnames))
+
+# The numbers of the rows of the tables that need them; see SchemaTable. Rows are
+# only inserted by the indexer process, and next() on a count is atomic.
+insert_sequence = count(1)
+
+class BulkInserter:
+  """ Buffers rows for the tables of the given schemata, and inserts them with
+      one executemany per table once batch_size rows are pending, committing
+      after each batch. Call flush() after the last row. """
+  def __init__(self, conn, schemata, batch_size=10000):
+    self.conn = conn
+    self.tables = {}
+    for schema in schemata:
+      self.tables.update(schema.tables)
+    self.batch_size = batch_size
+    self.pending = {}
+    self.count = 0
+
+  def add(self, tblname, args):
+    """ Queues the row args, a {col: value} dictionary or a record, for table
+        tblname. """
+    rows = self.pending.get(tblname)
+    if rows is None:
+      rows = self.pending[tblname] = []
+    rows.append(self.tables[tblname].get_row(args))
+    self.count += 1
+    if self.count >= self.batch_size:
+      self.flush()
+      self.conn.commit()
+
+  def flush(self):
+    """ Inserts all pending rows. """
+    for tblname, rows in self.pending.iteritems():
+      self.tables[tblname].insert_rows(self.conn, rows)
+    self.pending = {}
+    self.count = 0
 
 def make_get_schema_func(schema):
   """ Returns a function that satisfies get_schema's contract from the given
@@ -243,31 +402,153 @@ def make_get_schema_func(schema):
     return schema.get_create_sql()
   return get_schema
 
+def make_get_table_access_func(*schemata):
+  """ Returns a function that satisfies get_table_access's contract for a
+      build_database that reads and writes the tables of the given schema
+      objects. """
+  def get_table_access():
+    tables = []
+    for schema in schemata:
+      tables.extend(schema.tables)
+    return tables, tables
+  return get_table_access
+
+def make_build_indexes_func(*schemata):
+  """ Returns a function that satisfies build_indexes's contract from the
+      given schema objects. """
+  def build_indexes(conn, lookups=True):
+    for schema in schemata:
+      schema.build_indexes(conn, lookups)
+  return build_indexes
+
 def required_exports():
   """ Returns the required exports for a module, for use as __all__. """
   return ['post_process', 'build_database', 'sqlify', 'can_use', 'get_htmlifiers', 'get_schema',
     'pre_html_process']
 
+# The number of worker processes plugins should use, set by the indexer from
+# the tree's configuration
+workers = None
+def get_workers():
+  """ Returns the number of worker processes a plugin may use. """
+  if workers is None:
+    return cpu_count()
+  return workers
+
+# The worker processes that plugins hand their parsing and other work that does
+# not touch the database to; see get_pool.
+pool = None
+
+def start_pool():
+  """ Starts the get_workers() processes of get_pool. The indexer does this
+      before any of its stages runs: a process forked while another thread is
+      in sqlite can inherit one of its mutexes locked and hang. The plugins
+      have to be imported by then, so that the workers can find their
+      functions. """
+  global pool
+  pool = Pool(processes=get_workers())
+
+def stop_pool():
+  """ Stops the processes of get_pool, dropping any work still pending. """
+  global pool
+  if pool is not None:
+    pool.terminate()
+    pool.join()
+    pool = None
+
+def get_pool():
+  """ Returns the worker pool of the plugins, starting it if needed. """
+  if pool is None:
+    start_pool()
+  return pool
+
+# IDs are unique across the whole database. They are handed out from blocks
+# that are reserved in its global_ids table, so that any number of processes
+# can hand them out without colliding and without going to the database for
+# every one of them. The indexer sets the database with set_id_database.
+id_database = None
+id_block_size = 4096
+
+class IdBlock(threading.local):
+  """ The block next_global_id hands out IDs from. Plugins run in threads of
+      their own, so every thread has its own block. """
+  pid = None
+  next = 0
+  end = 0
+id_block = IdBlock()
+id_lock = threading.Lock()
+
+def set_id_database(path):
+  """ Makes the following IDs come from the database at path, or from this
+      process alone if path is None. Blocks of the database are reserved on
+      the connection passed to next_global_id, which is then required. """
+  global id_database, id_block, last_id
+  id_database = path
+  id_block = IdBlock()
+  last_id = 0
+
 last_id = 0
-def next_global_id():
-  """ Returns a unique identifier that is unique compared to other IDs. """
+def reserve_ids(count, conn=None):
+  """ Reserves count consecutive IDs and returns the first of them. Workers may
+      reserve blocks concurrently and then number their rows by themselves.
+
+      The high-water mark is updated in the transaction of conn, the connection
+      the caller writes to the database with; it is committed along with the
+      rows of the caller. conn is required once set_id_database has set the
+      database: a connection of our own would have to wait for the write lock
+      of every uncommitted transaction, that of the caller included. """
   global last_id
-  last_id += 1
-  return last_id
+  if conn is not None:
+    conn.execute('UPDATE global_ids SET last_id = last_id + ?', (count,))
+    last = conn.execute('SELECT last_id FROM global_ids').fetchone()[0]
+    return last - count + 1
+  if id_database is not None:
+    raise ValueError('IDs of %s have to be reserved on a connection to it' %
+                     id_database)
+  with id_lock:
+    last_id += count
+    return last_id - count + 1
+
+def next_global_id(conn=None):
+  """ Returns a unique identifier that is unique compared to other IDs. conn
+      is the connection the caller writes with; see reserve_ids. """
+  block = id_block
+  next = block.next
+  if next == block.end or block.pid != os.getpid():
+    # A forked process must not hand out the rest of its parent's block
+    next = reserve_ids(id_block_size, conn)
+    block.pid = os.getpid()
+    block.end = next + id_block_size
+  block.next = next + 1
+  return next
 
 language_by_file = None
 
-def break_into_files(blob, tablelocs):
+def break_into_files(blob, tablelocs, conn):
+  """ Splits the tables of blob by file, along with the records of the
+      language tables. tablelocs maps the tables to their location column.
+      conn is a connection to the database of the tree, whose files table has
+      the paths of the file_id of the language records. """
   global language_by_file
 
-  # The following method builds up the file table
-  def add_to_files(inblob, cols):
+  # The following method builds up the file table. Rows go to the file of their
+  # location column, or if paths is given, to the path of the file ID in it.
+  def add_to_files(inblob, cols, paths=None):
     filetable = {}
     for tblname, lockey in cols.iteritems():
       intable = inblob[tblname]
       tbliter = isinstance(intable, dict) and intable.itervalues() or intable
       for row in tbliter:
-        fname = row[lockey].split(":")[0]
+        # Records are kept as dictionaries, like the rows of the plugins, so
+        # that the per-file data can be marshalled
+        if not isinstance(row, dict):
+          row = dict(row._asdict())
+        if paths is not None:
+          fname = paths.get(row[lockey])
+          if fname is None:
+            continue
+        else:
+          fname = row[lockey].split(":")[0]
         try:
           tbl = filetable[fname]
         except KeyError:
@@ -275,15 +556,18 @@ def break_into_files(blob, tablelocs):
         tbl[tblname].append(row)
     return filetable
 
-  # Build the map for total stuff
+  # Build the map for total stuff. The records of the language tables have
+  # their location split into file_id, file_line and file_col.
   standard_keys = {
-    'scopes': 'sloc',
-    'functions': 'floc',
-    'variables': 'vloc',
-    'types': 'tloc'
+    'scopes': 'file_id',
+    'functions': 'file_id',
+    'variables': 'file_id',
+    'types': 'file_id'
   }
   if language_by_file is None:
-    language_by_file = add_to_files(dxr.languages.language_data, standard_keys)
+    paths = dict(conn.execute('SELECT ID, path FROM files'))
+    language_by_file = add_to_files(dxr.languages.language_data, standard_keys,
+                                    paths)
 
   # Build our map for a specific plugin
   perfile = add_to_files(blob, tablelocs)
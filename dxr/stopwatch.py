@@ -1,11 +1,41 @@
 #!/usr/bin/env python2
 
+from contextlib import contextmanager
+import heapq
+import os
+import threading
 import time
 
+def cputime():
+  """ CPU time of this process and of the children it has waited for """
+  t = os.times()
+  return t[0] + t[1] + t[2] + t[3]
+
 class StopWatch:
+  """ Measures where the time goes.
+
+      start/stop/elapsed accumulate CPU time under flat keys. span() times a
+      block in both wall and CPU time; spans opened inside another span on the
+      same thread are nested below it, and threads started inside a span can
+      nest theirs below it with within(). count() adds to a counter, both in
+      total and on the innermost open span, and sample() keeps the slowest
+      items of a kind. report() returns all of it as a JSON-friendly
+      dictionary.
+
+      Note that CPU time is that of the whole process, so the CPU time of spans
+      that run concurrently overlaps. """
+  # How many items sample() keeps per kind
+  slowest = 20
+
   def __init__ (self):
     self.timers = {}
     self.accumulated = {}
+    self.created = time.time()
+    self.spans = []
+    self.counters = {}
+    self.samples = {}
+    self.lock = threading.Lock()
+    self.local = threading.local()
 
   def start (self, task_str):
     self.timers[task_str] = time.clock()
@@ -29,3 +59,111 @@ class StopWatch:
       el += time.clock () - self.timers[task_str]
 
     return el
+
+  def _stack (self):
+    try:
+      return self.local.stack
+    except AttributeError:
+      self.local.stack = []
+      return self.local.stack
+
+  def current (self):
+    """ Returns the innermost open span of this thread, or None """
+    stack = self._stack()
+    if stack:
+      return stack[-1]
+    return None
+
+  @contextmanager
+  def within (self, parent):
+    """ Nests the spans of the enclosed block below parent, a span returned by
+        current() on the thread that started this one. """
+    saved = self._stack()
+    self.local.stack = parent is not None and [parent] or []
+    try:
+      yield
+    finally:
+      self.local.stack = saved
+
+  @contextmanager
+  def span (self, name, kind=None):
+    """ Times the enclosed block as a span named name. kind groups spans in
+        the summary of the report, e.g. 'stage' or 'plugin'. """
+    stack = self._stack()
+    if stack:
+      path = stack[-1]['path'] + '/' + name
+    else:
+      path = name
+    record = {'name': name, 'path': path, 'kind': kind,
+              'thread': threading.currentThread().getName(),
+              'start': time.time() - self.created, 'counters': {}}
+    stack.append(record)
+    wall, cpu = time.time(), cputime()
+    try:
+      yield record
+    finally:
+      record['wall'] = time.time() - wall
+      record['cpu'] = cputime() - cpu
+      stack.pop()
+      self.lock.acquire()
+      try:
+        self.spans.append(record)
+      finally:
+        self.lock.release()
+
+  def count (self, name, n=1, total=True):
+    """ Adds n to the counter name. If total is False, it is only added to
+        the innermost open span, for counters whose sum over unrelated spans
+        means nothing. """
+    stack = self._stack()
+    self.lock.acquire()
+    try:
+      # Spans may be shared with other threads; see within()
+      if stack:
+        counters = stack[-1]['counters']
+        counters[name] = counters.get(name, 0) + n
+      if total:
+        self.counters[name] = self.counters.get(name, 0) + n
+    finally:
+      self.lock.release()
+
+  def sample (self, kind, item, seconds):
+    """ Records that item of the given kind took seconds, keeping only the
+        slowest ones. """
+    self.lock.acquire()
+    try:
+      heap = self.samples.setdefault(kind, [])
+      if len(heap) < self.slowest:
+        heapq.heappush(heap, (seconds, item))
+      else:
+        heapq.heappushpop(heap, (seconds, item))
+    finally:
+      self.lock.release()
+
+  def report (self):
+    """ Returns all spans, counters and samples, and a summary of the spans
+        by kind and name. """
+    summary = {}
+    for record in self.spans:
+      if record['kind'] is None:
+        continue
+      entry = summary.setdefault(record['kind'], {}).setdefault(record['name'],
+        {'wall': 0.0, 'cpu': 0.0, 'spans': 0, 'counters': {}})
+      entry['wall'] += record['wall']
+      entry['cpu'] += record['cpu']
+      entry['spans'] += 1
+      for name, n in record['counters'].iteritems():
+        entry['counters'][name] = entry['counters'].get(name, 0) + n
+    return {
+      'created': self.created,
+      'wall': time.time() - self.created,
+      'cpu': cputime(),
+      'timers': dict((task, self.elapsed(task))
+                     for task in set(self.timers) | set(self.accumulated)),
+      'spans': sorted(self.spans, key=lambda record: record['start']),
+      'summary': summary,
+      'counters': self.counters,
+      'slowest': dict((kind, [[item, seconds] for seconds, item in
+                              sorted(heap, reverse=True)])
+                      for kind, heap in self.samples.iteritems()),
+    }
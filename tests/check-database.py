@@ -5,6 +5,7 @@ sys.path.append('..')
 
 import ConfigParser
 import imp, dxr
+import os
 
 # Read in the configuration for the test
 tests = ConfigParser.ConfigParser()
@@ -16,9 +17,17 @@ dxrcfg = dxr.load_config(tests.get(testname, 'dxrconfig'))
 if len(dxrcfg.trees) != 1:
   raise Exception('Database can only have one tree')
 tree = dxrcfg.trees[0]
-big_blob = dxr.load_big_blob(tree)
-# For the purposes of language data, dxr.languages.language_data too
-big_blob['dxr.language_data'] = dxr.languages.language_data
+# The data of the last generation, stored by the xref-only run
+big_blob = dxr.load_big_blob(tree, os.path.join(tree.wwwdir,
+                                                tree.tree + '-current'))
+# For the purposes of language data, dxr.languages.language_data too. Its rows
+# are records, which are compared as dictionaries like the rest of the blob.
+def as_dicts(table):
+  if isinstance(table, dict):
+    return dict((key, dict(row._asdict())) for key, row in table.iteritems())
+  return [dict(row._asdict()) for row in table]
+big_blob['dxr.language_data'] = dict((name, as_dicts(table)) for name, table
+                                     in dxr.languages.language_data.iteritems())
 
 # Load the checker data
 load_data = open(tests.get(testname, 'checkdb'))
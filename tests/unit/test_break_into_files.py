@@ -0,0 +1,52 @@
+#!/usr/bin/env python2
+""" Splitting plugin data by file, with the records of the language tables. """
+
+import marshal
+import os
+import sqlite3
+import sys
+import unittest
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(testdir)))
+
+import dxr.languages
+import dxr.plugins
+
+class BreakIntoFilesTest(unittest.TestCase):
+  def setUp(self):
+    self.saved = dxr.languages.language_data
+    dxr.languages.language_data = dxr.languages.language_schema.get_empty_blob()
+    dxr.plugins.language_by_file = None
+    self.conn = sqlite3.connect(':memory:')
+    self.conn.executescript(dxr.languages.get_standard_schema())
+    self.conn.executemany('INSERT INTO files (ID, path) VALUES (?, ?)',
+                          [(1, 'b.idl'), (2, 'a.idl')])
+
+  def tearDown(self):
+    dxr.languages.language_data = self.saved
+    dxr.plugins.language_by_file = None
+
+  def test_records(self):
+    functions = dxr.languages.language_schema.tables['functions']
+    dxr.languages.language_data['functions'][7] = functions.get_row({
+      'funcid': 7, 'fname': 'f', 'fqualname': 'ns::f', 'fargs': '()',
+      'ftype': 'void', 'file_id': 2, 'file_line': 3, 'file_col': 1})
+    dxr.languages.register_language_table('native', 'functions', [{
+      'funcid': 8, 'fname': 'g', 'fqualname': 'g', 'fargs': '()',
+      'ftype': 'void', 'file_id': 1, 'file_line': 5, 'file_col': 1}])
+    blob = {'interfaces': {'I': {'iname': 'I', 'iloc': 'a.idl:1:1'}}}
+
+    byfile = dxr.plugins.break_into_files(blob, {'interfaces': 'iloc'},
+                                          self.conn)
+    self.assertEqual(byfile.keys(), ['a.idl'])
+    self.assertEqual(byfile['a.idl']['interfaces'],
+                     [{'iname': 'I', 'iloc': 'a.idl:1:1'}])
+    self.assertEqual(len(byfile['a.idl']['functions']), 1)
+    self.assertEqual(byfile['a.idl']['functions'][0]['fqualname'], 'ns::f')
+    self.assertEqual(byfile['a.idl']['types'], [])
+    # The per-file data is stored with marshal
+    marshal.dumps(byfile['a.idl'])
+
+if __name__ == '__main__':
+  unittest.main()
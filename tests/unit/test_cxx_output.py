@@ -0,0 +1,157 @@
+#!/usr/bin/env python2
+""" Round trip of the csv and binary output of the clang plugin, through the
+    output code of dxr-index.cpp and the readers of the cxx-clang indexer. """
+
+import imp
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+dxrroot = os.path.dirname(os.path.dirname(testdir))
+plugindir = os.path.join(dxrroot, 'xref-tools', 'cxx-clang')
+sys.path.insert(0, dxrroot)
+
+import dxr
+import dxr.languages
+import dxr.plugins
+indexer = imp.load_source('dxr.cxx-clang',
+                          os.path.join(plugindir, 'indexer.py'))
+
+expected = [
+  ('decldef', {'name': 'ns::f', 'declloc': ('a.cpp', 1, 5),
+               'defloc': ('--GENERATED--/gen.h', 300, 1)}),
+  ('type', {'tname': 'S', 'tqualname': 'ns::S', 'tloc': ('a.cpp', 3, 8),
+            'tkind': 'struct', 'scopename': 'ns',
+            'scopeloc': ('a.cpp', 2, 11), 'extent': (70000, 70001)}),
+  ('impl', {'tcname': 'ns::D', 'tcloc': ('a.cpp', 5, 8), 'tbname': 'ns::S',
+            'tbloc': ('a.cpp', 3, 8), 'access': ''}),
+  ('ref', {'varname': 'ns::x', 'varloc': ('a.cpp', 7, 5),
+           'refloc': ('a.cpp', 9, 3), 'extent': (0, 3)}),
+  ('warning', {'wloc': ('a.cpp', 9, 1), 'wmsg': 'unused "x", really'}),
+  ('macro', {'macroloc': ('a.cpp', 11, 9), 'macroname': 'M',
+             'macroargs': '(a, b)', 'macrotext': '"a" #b'}),
+]
+
+class CxxOutputTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.tmpdir = tempfile.mkdtemp()
+    cls.writer = os.path.join(cls.tmpdir, 'write-records')
+    try:
+      subprocess.check_call([os.environ.get('CXX', 'g++'), '-Wall',
+                             '-I' + plugindir,
+                             os.path.join(testdir, 'write-records.cpp'),
+                             '-o', cls.writer])
+    except OSError:
+      shutil.rmtree(cls.tmpdir)
+      raise unittest.SkipTest('no C++ compiler')
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.tmpdir)
+
+  def write(self, name, *args):
+    fname = os.path.join(self.tmpdir, name)
+    subprocess.check_call([self.writer, fname] + list(args))
+    return fname
+
+  def test_csv(self):
+    fname = self.write('a.csv')
+    self.assertEqual(open(fname).read().count('\n'), len(expected))
+    self.assertEqual(indexer.parse_indexer_output(fname), expected)
+
+  def test_binary(self):
+    fname = self.write('a.dxrb', 'binary')
+    self.assertEqual(indexer.parse_indexer_output(fname), expected)
+
+  def test_same_records(self):
+    csv = indexer.parse_indexer_output(self.write('a.csv'))
+    binary = indexer.parse_indexer_output(self.write('a.dxrb', 'binary'))
+    self.assertEqual(csv, binary)
+
+class ParseTest(unittest.TestCase):
+  def setUp(self):
+    fd, self.fname = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+
+  def tearDown(self):
+    os.unlink(self.fname)
+
+  def test_unused_locations(self):
+    # References without an extent are dropped, and only the locations that
+    # are used are split, so neither of these gets in the way
+    f = open(self.fname, 'w')
+    f.write('ref,varname,"x",varloc,"a.cpp:bad",refloc,"a.cpp:2:1"\n')
+    f.write('warning,wloc,"a.cpp:3:1",wmsg,"m",otherloc,"bad"\n')
+    f.close()
+    self.assertEqual(indexer.parse_indexer_output(self.fname),
+                     [('warning', {'wloc': ('a.cpp', 3, 1), 'wmsg': 'm',
+                                   'otherloc': 'bad'})])
+
+class RemapDeclarationsTest(unittest.TestCase):
+  def setUp(self):
+    self.conn = sqlite3.connect(':memory:')
+    self.conn.executescript(dxr.languages.get_standard_schema() +
+                            indexer.get_schema())
+    indexer.decl_master.clear()
+
+  def tearDown(self):
+    indexer.decl_master.clear()
+
+  def test_name(self):
+    schema = dxr.languages.language_schema
+    schema.insert_rows(self.conn, 'functions', [schema.get_row('functions', {
+      'funcid': 3, 'fname': 'f', 'fqualname': 'ns::f', 'fargs': '()',
+      'ftype': 'void', 'file_id': 1, 'file_line': 9, 'file_col': 1})])
+    # Two declarations with their definition at the location of f; only the
+    # one with its name is a declaration of f
+    indexer.decl_master['f', 1, 2, 1] = (1, 9, 1)
+    indexer.decl_master['g', 1, 4, 1] = (1, 9, 1)
+    indexer.build_symbol_locations(self.conn)
+    indexer.remap_declarations(self.conn)
+    indexer.drop_symbol_locations(self.conn)
+    self.assertEqual(self.conn.execute(
+      'SELECT defid, file_id, file_line, file_col FROM decldef').fetchall(),
+      [(3, 1, 2, 1)])
+
+class BuildDatabaseTest(unittest.TestCase):
+  def setUp(self):
+    self.objdir = tempfile.mkdtemp()
+    f = open(os.path.join(self.objdir, 'a.csv'), 'w')
+    f.write('type,tname,"S",tqualname,"S",tloc,"a.cpp:3:8",tkind,"struct"\n')
+    f.write('function,fname,"f",fqualname,"f",ftype,"void",fargs,"()",'
+            'floc,"a.cpp:5:6",scopename,"S",scopeloc,"a.cpp:3:8"\n')
+    f.close()
+    self.conn = sqlite3.connect(':memory:')
+    # Like the connections of the indexer
+    self.conn.row_factory = sqlite3.Row
+    self.conn.executescript(dxr.languages.get_standard_schema() +
+                            indexer.get_schema())
+    for table in (indexer.file_cache, indexer.scope_map, indexer.decl_master):
+      table.clear()
+    del indexer.file_names[:]
+
+  def tearDown(self):
+    dxr.plugins.stop_pool()
+    shutil.rmtree(self.objdir)
+
+  def test_walked_files(self):
+    # The walk stage adds the files of the tree while the plugins run
+    self.conn.executemany('INSERT INTO files (path) VALUES (?)',
+                          [('b.cpp',), ('a.cpp',)])
+    self.conn.commit()
+    indexer.build_database(self.conn, self.objdir, self.objdir)
+    self.assertEqual(map(tuple, self.conn.execute(
+      'SELECT tname, file_id, file_line FROM types')), [('S', 2, 3)])
+    self.assertEqual(map(tuple, self.conn.execute(
+      'SELECT fname, file_id, file_line FROM functions')), [('f', 2, 5)])
+    self.assertEqual(self.conn.execute(
+      'SELECT COUNT(*) FROM files').fetchone()[0], 2)
+
+if __name__ == '__main__':
+  unittest.main()
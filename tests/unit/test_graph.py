@@ -0,0 +1,70 @@
+#!/usr/bin/env python2
+""" The transitive closure of dxr.graph, against a plain search. """
+
+import os
+import random
+import sys
+import unittest
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(testdir)))
+
+import dxr.graph
+
+def search(graph, node):
+  """ The nodes reachable from node, one depth-first search at a time """
+  seen = set()
+  todo = list(graph.get(node, ()))
+  while todo:
+    succ = todo.pop()
+    if succ not in seen:
+      seen.add(succ)
+      todo.extend(graph.get(succ, ()))
+  return seen
+
+class ReachableTest(unittest.TestCase):
+  def test_chain(self):
+    reach = dxr.graph.reachable({'a': ['b'], 'b': ['c']})
+    self.assertEqual(reach, {'a': set(['b', 'c']), 'b': set(['c']),
+                             'c': set()})
+
+  def test_diamond(self):
+    reach = dxr.graph.reachable({'d': ['b', 'c'], 'b': ['a'], 'c': ['a']})
+    self.assertEqual(reach['d'], set(['a', 'b', 'c']))
+    self.assertEqual(reach['a'], set())
+
+  def test_cycles(self):
+    # Only nodes on a cycle reach themselves
+    reach = dxr.graph.reachable({1: [2], 2: [3], 3: [2, 4], 5: [5]})
+    self.assertEqual(reach[1], set([2, 3, 4]))
+    self.assertEqual(reach[2], set([2, 3, 4]))
+    self.assertEqual(reach[3], set([2, 3, 4]))
+    self.assertEqual(reach[4], set())
+    self.assertEqual(reach[5], set([5]))
+
+  def test_long_chain(self):
+    # Deeper than the recursion limit
+    n = sys.getrecursionlimit() * 2
+    graph = dict((i, [i + 1]) for i in xrange(n))
+    reach = dxr.graph.reachable(graph)
+    self.assertEqual(len(reach[0]), n)
+    self.assertEqual(reach[n - 1], set([n]))
+
+  def test_random(self):
+    rand = random.Random(7)
+    for i in range(50):
+      nodes = range(rand.randint(1, 30))
+      graph = {}
+      for j in range(rand.randint(0, 60)):
+        graph.setdefault(rand.choice(nodes), []).append(rand.choice(nodes))
+      reach = dxr.graph.reachable(graph)
+      for node in reach:
+        self.assertEqual(reach[node], search(graph, node))
+      # Every node of the graph is in the result, sinks included
+      expected = set(graph)
+      for succs in graph.itervalues():
+        expected.update(succs)
+      self.assertEqual(set(reach), expected)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python2
+""" The global IDs, which are reserved in blocks on the writer's connection. """
+
+import imp
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+dxrroot = os.path.dirname(os.path.dirname(testdir))
+sys.path.insert(0, dxrroot)
+
+import dxr.languages
+import dxr.plugins
+moztools = imp.load_source('dxr.moztools',
+                           os.path.join(dxrroot, 'xref-tools', 'moztools',
+                                        'indexer.py'))
+
+class IdTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.dbpath = os.path.join(self.tmpdir, 't.sqlite')
+    self.conn = sqlite3.connect(self.dbpath)
+    self.conn.executescript(dxr.languages.get_standard_schema())
+    dxr.plugins.set_id_database(self.dbpath)
+
+  def tearDown(self):
+    dxr.plugins.set_id_database(None)
+    self.conn.close()
+    shutil.rmtree(self.tmpdir)
+
+  def last_id(self, conn):
+    return conn.execute('SELECT last_id FROM global_ids').fetchone()[0]
+
+  def test_blocks(self):
+    first = dxr.plugins.reserve_ids(10, self.conn)
+    self.assertEqual(first, 1)
+    self.assertEqual(dxr.plugins.reserve_ids(5, self.conn), 11)
+    # The reservation is part of the transaction of the caller
+    other = sqlite3.connect(self.dbpath)
+    self.assertEqual(self.last_id(other), 0)
+    self.conn.commit()
+    self.assertEqual(self.last_id(other), 15)
+    other.close()
+
+  def test_next_global_id(self):
+    ids = [dxr.plugins.next_global_id(self.conn) for i in range(3)]
+    self.assertEqual(ids, [1, 2, 3])
+    self.assertEqual(self.last_id(self.conn), dxr.plugins.id_block_size)
+
+  def test_connection_required(self):
+    self.assertRaises(ValueError, dxr.plugins.reserve_ids, 10)
+    dxr.plugins.set_id_database(None)
+    self.assertEqual(dxr.plugins.reserve_ids(10), 1)
+    self.assertEqual(dxr.plugins.reserve_ids(10), 11)
+
+  def test_moztools(self):
+    objdir = os.path.join(self.tmpdir, 'obj')
+    os.mkdir(objdir)
+    f = open(os.path.join(objdir, 'a.idlcsv'), 'w')
+    f.write('interface,name,nsIA,iloc,/src/a.idl:3\n')
+    f.write('method,iface,nsIA,name,run,loc,/src/a.idl:5\n')
+    f.write('const,iface,nsIA,name,ONE,loc,/src/a.idl:4\n')
+    f.close()
+    for table in (moztools.interfaces, moztools.attributes, moztools.methods,
+                  moztools.consts):
+      table.clear()
+
+    blob = moztools.post_process('/src', objdir)
+    self.assertEqual(self.last_id(self.conn), 0)
+    moztools.build_database(self.conn, '/src', objdir, blob)
+    self.assertEqual(blob['interfaces']['nsIA']['iid'], 1)
+    self.assertEqual(blob['methods'].keys(), [blob['methods'].values()[0]['funcid']])
+    self.assertEqual(blob['consts'].values()[0]['iid'], 1)
+    self.assertEqual(blob['methods'].values()[0]['loc'], 'a.idl:5')
+    self.assertEqual(self.last_id(self.conn), dxr.plugins.id_block_size)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python2
+""" The carry-over of the full-text rows of unchanged files in incremental
+    runs of dxr-index.py. """
+
+import imp
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+dxrroot = os.path.dirname(os.path.dirname(testdir))
+sys.path.insert(0, dxrroot)
+
+import dxr.languages
+import dxr.manifest
+dxrindex = imp.load_source('dxr_index', os.path.join(dxrroot, 'dxr-index.py'))
+
+def makedb(path, files, fts=()):
+  """ Creates a database with the given (ID, path) files and (rowid, basename,
+      content) full-text rows. """
+  conn = sqlite3.connect(path)
+  conn.text_factory = str
+  conn.executescript(dxr.languages.get_standard_schema())
+  conn.executemany('INSERT INTO files (ID, path) VALUES (?, ?)', files)
+  conn.execute('CREATE VIRTUAL TABLE fts USING fts4 (basename, content)')
+  conn.executemany('INSERT INTO fts (rowid, basename, content) VALUES (?, ?, ?)',
+                   fts)
+  conn.commit()
+  return conn
+
+class CarryIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.prevdb = os.path.join(self.tmpdir, 'prev.sqlite')
+    makedb(self.prevdb, [(1, 'a.c'), (2, 'sub/b.c'), (3, 'gone.c')],
+           [(1, 'a.c', 'int a;'), (2, 'b.c', 'int b;'),
+            (3, 'gone.c', 'int gone;')]).close()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_rows_follow_paths(self):
+    # The files get other IDs in the new database
+    conn = makedb(os.path.join(self.tmpdir, 'new.sqlite'),
+                  [(10, 'sub/b.c'), (11, 'new.c'), (12, 'a.c')])
+    copied = dxrindex.carry_index(conn, self.prevdb, ['a.c', 'sub/b.c'])
+    self.assertEqual(copied, set(['a.c', 'sub/b.c']))
+    self.assertEqual(sorted(conn.execute('SELECT rowid, content FROM fts')),
+                     [(10, 'int b;'), (12, 'int a;')])
+    self.assertEqual(conn.execute('SELECT COUNT(*) FROM files').fetchone()[0],
+                     3)
+
+  def test_missing_rows(self):
+    # Files that the previous database has no rows for are not carried, but
+    # still get an ID
+    conn = makedb(os.path.join(self.tmpdir, 'new.sqlite'), [(5, 'a.c')])
+    copied = dxrindex.carry_index(conn, self.prevdb, ['a.c', 'other.c'])
+    self.assertEqual(copied, set(['a.c']))
+    self.assertEqual(sorted(conn.execute('SELECT path FROM files')),
+                     [('a.c',), ('other.c',)])
+    self.assertEqual(list(conn.execute('SELECT rowid FROM fts')), [(5,)])
+
+  def test_missing_database(self):
+    # Everything is indexed again, and the previous generation is left alone
+    conn = makedb(os.path.join(self.tmpdir, 'new.sqlite'), [(5, 'a.c')])
+    prevdb = os.path.join(self.tmpdir, 'old', 'prev.sqlite')
+    os.mkdir(os.path.dirname(prevdb))
+    self.assertEqual(dxrindex.carry_index(conn, prevdb, ['a.c']), set())
+    self.assertFalse(os.path.exists(prevdb))
+    self.assertEqual(list(conn.execute('SELECT rowid FROM fts')), [])
+
+class DiffManifestsTest(unittest.TestCase):
+  def entry(self, digest):
+    return {'size': 1, 'mtime': 1.0, 'sha1': digest, 'text': True}
+
+  def test_diff(self):
+    old = {'a.c': self.entry('1'), 'b.c': self.entry('2'),
+           'gone.c': self.entry('3')}
+    new = {'a.c': self.entry('1'), 'b.c': self.entry('4'),
+           'new.c': self.entry('5')}
+    self.assertEqual(dxr.manifest.diff_manifests(old, new),
+                     (set(['new.c']), set(['b.c']), set(['gone.c']),
+                      set(['a.c'])))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python2
+""" Storing pages in the object store and collecting the unused ones. """
+
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(testdir)))
+
+import dxr.objstore
+
+def read(path):
+  f = open(path, 'rb')
+  try:
+    return f.read()
+  finally:
+    f.close()
+
+class ObjectStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.wwwdir = tempfile.mkdtemp()
+    self.store = dxr.objstore.get_store(self.wwwdir)
+    self.gen1 = os.path.join(self.wwwdir, 'gen1')
+    self.gen2 = os.path.join(self.wwwdir, 'gen2')
+    os.mkdir(self.gen1)
+    os.mkdir(self.gen2)
+
+  def tearDown(self):
+    shutil.rmtree(self.wwwdir)
+
+  def objects(self):
+    return sorted(name for subdir in os.listdir(self.store)
+                  for name in os.listdir(os.path.join(self.store, subdir)))
+
+  def test_put(self):
+    a = os.path.join(self.gen1, 'a.html')
+    b = os.path.join(self.gen2, 'a.html')
+    self.assertTrue(dxr.objstore.put(self.store, 'page', a))
+    # The same page is only linked again
+    self.assertFalse(dxr.objstore.put(self.store, 'page', b))
+    self.assertEqual(read(b), 'page')
+    self.assertEqual(os.stat(a).st_ino, os.stat(b).st_ino)
+    self.assertEqual(os.stat(a).st_nlink, 3)
+    self.assertEqual(len(self.objects()), 1)
+
+  def test_collect(self):
+    dxr.objstore.put(self.store, 'old', os.path.join(self.gen1, 'a.html'))
+    dxr.objstore.put(self.store, 'both', os.path.join(self.gen1, 'b.html'))
+    dxr.objstore.put(self.store, 'both', os.path.join(self.gen2, 'b.html'))
+    dxr.objstore.put(self.store, 'new', os.path.join(self.gen2, 'a.html'))
+    self.assertEqual(dxr.objstore.collect(self.store), 0)
+
+    shutil.rmtree(self.gen1)
+    self.assertEqual(dxr.objstore.collect(self.store), 1)
+    self.assertEqual(len(self.objects()), 2)
+    self.assertEqual(read(os.path.join(self.gen2, 'b.html')), 'both')
+    # A page that was collected is written again
+    self.assertTrue(dxr.objstore.put(self.store, 'old',
+                                     os.path.join(self.gen2, 'c.html')))
+    self.assertEqual(len(self.objects()), 3)
+
+  def test_collect_skips_temporary(self):
+    objdir = os.path.join(self.store, 'ab')
+    os.mkdir(objdir)
+    open(os.path.join(objdir, '.tmpXYZ'), 'w').close()
+    self.assertEqual(dxr.objstore.collect(self.store), 0)
+    self.assertTrue(os.path.exists(os.path.join(objdir, '.tmpXYZ')))
+
+  def test_no_links(self):
+    # Without hard links, the page is copied, and the object stays unused
+    def link(src, dst):
+      raise OSError(errno.EMLINK, 'Too many links')
+    saved = os.link
+    os.link = link
+    try:
+      dst = os.path.join(self.gen1, 'a.html')
+      self.assertTrue(dxr.objstore.put(self.store, 'page', dst))
+    finally:
+      os.link = saved
+    self.assertEqual(read(dst), 'page')
+    self.assertEqual(os.stat(dst).st_nlink, 1)
+    self.assertEqual(dxr.objstore.collect(self.store), 1)
+    self.assertEqual(read(dst), 'page')
+
+if __name__ == '__main__':
+  unittest.main()
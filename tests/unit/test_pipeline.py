@@ -0,0 +1,44 @@
+#!/usr/bin/env python2
+""" The spans of pipelines, which run their stages in threads of their own. """
+
+import os
+import sys
+import unittest
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(testdir)))
+
+import dxr.pipeline
+import dxr.stopwatch
+
+class PipelineSpanTest(unittest.TestCase):
+  def setUp(self):
+    self.watch = dxr.stopwatch.StopWatch()
+
+  def run_plugin(self, name):
+    with self.watch.span(name, 'plugin'):
+      self.watch.count('rows', 2)
+    return 3
+
+  def test_nested(self):
+    outer = dxr.pipeline.Pipeline('t', self.watch)
+    def xref():
+      inner = dxr.pipeline.Pipeline('t/xref', self.watch)
+      inner.add_stage('a', lambda: self.run_plugin('pa'))
+      inner.add_stage('b', lambda: self.run_plugin('pb'), ['a'])
+      inner.run()
+      return 1
+    outer.add_stage('xref', xref)
+    outer.run()
+
+    spans = dict((record['path'], record) for record in self.watch.spans)
+    self.assertEqual(sorted(spans),
+                     ['xref', 'xref/a', 'xref/a/pa', 'xref/b', 'xref/b/pb'])
+    # Items are only counted on the span of their stage
+    self.assertEqual(spans['xref']['counters'], {'items': 1})
+    self.assertEqual(spans['xref/a']['counters'], {'items': 3})
+    self.assertEqual(spans['xref/b/pb']['counters'], {'rows': 2})
+    self.assertEqual(self.watch.counters, {'rows': 4})
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python2
+""" The unique indexes of the schema, and the duplicates they remove. """
+
+import os
+import sqlite3
+import sys
+import unittest
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(testdir)))
+
+import dxr.languages
+
+class DedupTest(unittest.TestCase):
+  def setUp(self):
+    self.conn = sqlite3.connect(':memory:')
+    self.conn.executescript(dxr.languages.get_standard_schema())
+    self.schema = dxr.languages.language_schema
+
+  def insert_type(self, tid, tname, line):
+    self.schema.insert_rows(self.conn, 'types', [self.schema.get_row('types', {
+      'tid': tid, 'tname': tname, 'tqualname': tname, 'file_id': 1,
+      'file_line': line, 'file_col': 1})])
+
+  def test_first_inserted(self):
+    # IDs are handed out in blocks, so the row inserted first may well have
+    # the larger one
+    self.insert_type(9, 'first', 3)
+    self.insert_type(4, 'second', 3)
+    self.insert_type(5, 'other', 4)
+    self.schema.build_indexes(self.conn, lookups=False)
+    self.assertEqual(self.conn.execute(
+      'SELECT tid, tname FROM types ORDER BY tid').fetchall(),
+      [(5, 'other'), (9, 'first')])
+    # Later rows are ignored, as they would have been with the index there
+    self.insert_type(2, 'third', 4)
+    self.assertEqual(self.conn.execute(
+      'SELECT COUNT(*) FROM types').fetchone()[0], 2)
+
+  def test_missing_location(self):
+    # NULLs are never equal to each other in a unique index
+    self.insert_type(1, 'a', None)
+    self.insert_type(2, 'b', None)
+    self.schema.build_indexes(self.conn, lookups=False)
+    self.assertEqual(self.conn.execute(
+      'SELECT COUNT(*) FROM types').fetchone()[0], 2)
+
+  def test_opt_in(self):
+    # Only the tables that ask for it get the column
+    columns = lambda table: [row[1] for row in
+                             self.conn.execute('PRAGMA table_info(%s)' % table)]
+    self.assertTrue('insertseq' in columns('types'))
+    self.assertFalse('insertseq' in columns('files'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,70 @@
+// Writes a fixed set of records with the output code of the clang plugin, in
+// the binary format if the second argument is "binary" and as csv otherwise.
+// Used by test_cxx_output.py, since the plugin itself needs a clang build.
+
+#include <fstream>
+
+#include "dxr-output.h"
+
+int main(int argc, char **argv) {
+  if (argc < 2) {
+    std::cerr << "Usage: " << argv[0] << " <file> [binary]" << std::endl;
+    return 1;
+  }
+  srcdir = "/src";
+  output = "/obj/";
+  binary = argc > 2 && !strcmp(argv[2], "binary");
+
+  std::string source("/src/a.cpp"), generated("/obj/gen.h");
+  FileInfo a(source), gen(generated);
+  RecordWriter writer;
+
+  writer.beginRecord("decldef", &a);
+  writer.recordValue("name", "ns::f");
+  writer.recordLocation("declloc", &a, 1, 5);
+  writer.recordLocation("defloc", &gen, 300, 1);
+  writer.endRecord();
+
+  writer.beginRecord("type", &a);
+  writer.recordValue("tname", "S");
+  writer.recordValue("tqualname", "ns::S");
+  writer.recordLocation("tloc", &a, 3, 8);
+  writer.recordValue("tkind", "struct");
+  writer.recordValue("scopename", "ns");
+  writer.recordLocation("scopeloc", &a, 2, 11);
+  writer.recordExtent(70000, 70001);
+  writer.endRecord();
+
+  writer.beginRecord("impl", &a);
+  writer.recordValue("tcname", "ns::D");
+  writer.recordLocation("tcloc", &a, 5, 8);
+  writer.recordValue("tbname", "ns::S");
+  writer.recordLocation("tbloc", &a, 3, 8);
+  writer.recordValue("access", "");
+  writer.endRecord();
+
+  writer.beginRecord("ref", &a);
+  writer.recordValue("varname", "ns::x");
+  writer.recordLocation("varloc", &a, 7, 5);
+  writer.recordLocation("refloc", &a, 9, 3);
+  writer.recordExtent(0, 3);
+  writer.endRecord();
+
+  writer.beginRecord("warning", &a);
+  writer.recordLocation("wloc", &a, 9, 1);
+  writer.recordValue("wmsg", "unused \"x\", really", true);
+  writer.endRecord();
+
+  writer.beginRecord("macro", &a);
+  writer.recordLocation("macroloc", &a, 11, 9);
+  writer.recordValue("macroname", "M");
+  writer.recordValue("macroargs", "(a, b)");
+  writer.recordValue("macrotext", "\"a\" #b", true);
+  writer.endRecord();
+
+  std::ofstream out(argv[1], std::ios::out | std::ios::binary);
+  if (binary)
+    out << binaryMagic;
+  out << a.info.str();
+  return 0;
+}
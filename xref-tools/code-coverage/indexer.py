@@ -47,6 +47,13 @@ def post_process(srcdir, objdir):
 
   return blob
 
+def build_database(conn, srcdir, objdir, cache=None):
+  # The coverage data is only used by the htmlifiers
+  pass
+
+def get_table_access():
+  return [], []
+
 def can_use(treecfg):
   # We need to have clang and llvm-config in the path
   return dxr.plugins.in_path('lcov')
@@ -71,4 +78,4 @@ for f in ('.c', '.cc', '.cpp', '.h', '.hpp'):
 def get_htmlifiers():
   return htmlifier
 
-__all__ = dxr.plugins.required_exports()
+__all__ = dxr.plugins.required_exports() + ['get_table_access']
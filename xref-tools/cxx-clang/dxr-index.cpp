@@ -14,27 +14,19 @@
 #include <sstream>
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 
 // Needed for sha1 hacks
 #include <fcntl.h>
 #include <unistd.h>
 #include "sha1.h"
 
+#include "dxr-output.h"
+
 using namespace clang;
 
 namespace {
 
-// Curse whomever didn't do this.
-std::string &operator+=(std::string &str, unsigned int i) {
-  static char buf[15] = { '\0' };
-  char *ptr = &buf[13];
-  do {
-    *ptr-- = (i % 10) + '0';
-    i = i/10;
-  } while (i > 0);
-  return str += (ptr + 1);
-}
-
 // BEWARE: use only as a temporary
 const char *hash(std::string &str) {
   static unsigned char rawhash[20];
@@ -44,28 +36,6 @@ const char *hash(std::string &str) {
   return hashstr;
 }
 
-std::string srcdir;
-std::string output;
-
-struct FileInfo {
-  FileInfo(std::string &rname) : realname(rname) {
-    interesting = rname.compare(0, srcdir.length(), srcdir) == 0;
-    if (interesting) {
-      // Remove the trailing `/' as well.
-      realname.erase(0, srcdir.length() + 1);
-    } else if (rname.compare(0, output.length(), output) == 0) {
-      // We're in the output directory, so we are probably a generated header
-      // We use the escape character to indicate the objdir nature.
-      // Note that output also has the `/' already placed
-      interesting = true;
-      realname.replace(0, output.length(), "--GENERATED--/");
-    }
-  }
-  std::string realname;
-  std::ostringstream info;
-  bool interesting;
-};
-
 class IndexConsumer;
 
 class PreprocThunk : public PPCallbacks {
@@ -83,7 +53,7 @@ class IndexConsumer : public ASTConsumer,
 private:
   CompilerInstance &ci;
   SourceManager &sm;
-  std::ostream *out;
+  RecordWriter writer;
   std::map<std::string, FileInfo *> relmap;
   LangOptions &features;
   DiagnosticConsumer *inner;
@@ -112,8 +82,8 @@ private:
   }
 public:
   IndexConsumer(CompilerInstance &ci) :
-    ci(ci), sm(ci.getSourceManager()), features(ci.getLangOpts()),
-      m_currentFunction(NULL) {
+    ci(ci), sm(ci.getSourceManager()),
+      features(ci.getLangOpts()), m_currentFunction(NULL) {
     inner = ci.getDiagnostics().takeClient();
     ci.getDiagnostics().setClient(this, false);
     ci.getPreprocessor().addPPCallbacks(new PreprocThunk(this));
@@ -143,42 +113,29 @@ public:
     return f->interesting;
   }
 
-  std::string locationToString(SourceLocation loc) {
-    PresumedLoc fixed = sm.getPresumedLoc(loc);
-    std::string buffer = getFileInfo(fixed.getFilename())->realname;
-    buffer += ":";
-    buffer += fixed.getLine();
-    buffer += ":";
-    buffer += fixed.getColumn();
-    return buffer;
-  }
-
   void beginRecord(const char *name, SourceLocation loc) {
-    FileInfo *f = getFileInfo(sm.getPresumedLoc(loc).getFilename());
-    out = &f->info;
-    *out << name;
+    writer.beginRecord(name,
+      getFileInfo(sm.getPresumedLoc(loc).getFilename()));
+  }
+  void endRecord() {
+    writer.endRecord();
   }
   void recordValue(const char *key, std::string value, bool needQuotes=false) {
-    *out << "," << key << ",\"";
-    int start = 0;
-    if (needQuotes) {
-      int quote = value.find('"');
-      while (quote != -1) {
-        // Need to repeat the "
-        *out << value.substr(start, quote - start + 1) << "\"";
-        start = quote + 1;
-        quote = value.find('"', start);
-      }
-    }
-    *out << value.substr(start) << "\"";
+    writer.recordValue(key, value, needQuotes);
+  }
+  void recordLocation(const char *key, SourceLocation loc) {
+    PresumedLoc fixed = sm.getPresumedLoc(loc);
+    writer.recordLocation(key, getFileInfo(fixed.getFilename()),
+      fixed.getLine(), fixed.getColumn());
   }
 
   void printExtent(SourceLocation begin, SourceLocation end) {
     if (begin.isMacroID() || end.isMacroID())
       return;
-    *out << ",extent," << sm.getDecomposedSpellingLoc(begin).second << ":" <<
-      sm.getDecomposedSpellingLoc(
-        Lexer::getLocForEndOfToken(end, 0, sm, features)).second;
+    unsigned int start = sm.getDecomposedSpellingLoc(begin).second;
+    unsigned int stop = sm.getDecomposedSpellingLoc(
+      Lexer::getLocForEndOfToken(end, 0, sm, features)).second;
+    writer.recordExtent(start, stop);
   }
 
   void printScope(Decl *d) {
@@ -199,7 +156,7 @@ public:
           namesource = redecl;
       }
       recordValue("scopename", namesource->getQualifiedNameAsString());
-      recordValue("scopeloc", locationToString(scope->getLocation()));
+      recordLocation("scopeloc", scope->getLocation());
     }
   }
 
@@ -209,9 +166,9 @@ public:
 
     beginRecord("decldef", decl->getLocation());
     recordValue("name", decl->getQualifiedNameAsString());
-    recordValue("declloc", locationToString(decl->getLocation()));
-    recordValue("defloc", locationToString(def->getLocation()));
-    *out << std::endl;
+    recordLocation("declloc", decl->getLocation());
+    recordLocation("defloc", def->getLocation());
+    endRecord();
   }
 
   // All we need is to follow the final declaration.
@@ -227,13 +184,15 @@ public:
       std::string content = it->second->info.str();
       if (content.length() == 0)
         continue;
+      if (binary)
+        content.insert(0, binaryMagic);
       std::string filename = output;
       // Hashing the filename allows us to not worry about the file structure
       // not matching up.
       filename += hash(it->second->realname);
       filename += ".";
       filename += hash(content);
-      filename += ".csv";
+      filename += binary ? ".dxrb" : ".csv";
 
       // Okay, I want to use the standard library for I/O as much as possible,
       // but the C/C++ standard library does not have the feature of "open
@@ -268,12 +227,12 @@ public:
       nd = definition;
     recordValue("tname", nd->getNameAsString());
     recordValue("tqualname", nd->getQualifiedNameAsString());
-    recordValue("tloc", locationToString(definition->getLocation()));
+    recordLocation("tloc", definition->getLocation());
     recordValue("tkind", definition->getKindName());
     printScope(definition);
     // Linkify the name, not the `enum'
     printExtent(nd->getLocation(), nd->getLocation());
-    *out << std::endl;
+    endRecord();
 
     declDef(d, d->getDefinition());
     return true;
@@ -293,19 +252,20 @@ public:
         return true;
       beginRecord("impl", d->getLocation());
       recordValue("tcname", d->getQualifiedNameAsString());
-      recordValue("tcloc", locationToString(d->getLocation()));
+      recordLocation("tcloc", d->getLocation());
       recordValue("tbname", base->getQualifiedNameAsString());
-      recordValue("tbloc", locationToString(base->getLocation()));
-      *out << ",access,\"";
+      recordLocation("tbloc", base->getLocation());
+      std::string access;
       switch ((*iter).getAccessSpecifierAsWritten()) {
-      case AS_public: *out << "public"; break;
-      case AS_protected: *out << "protected"; break;
-      case AS_private: *out << "private"; break;
+      case AS_public: access = "public"; break;
+      case AS_protected: access = "protected"; break;
+      case AS_private: access = "private"; break;
       case AS_none: break; // It's implied, but we can ignore that
       }
       if ((*iter).isVirtual())
-        *out << " virtual";
-      *out << "\"" << std::endl;
+        access += " virtual";
+      recordValue("access", access);
+      endRecord();
     }
     return true;
   }
@@ -327,7 +287,7 @@ public:
       args.erase(1, 2);
     args += ")";
     recordValue("fargs", args);
-    recordValue("floc", locationToString(d->getLocation()));
+    recordLocation("floc", d->getLocation());
     printScope(d);
     printExtent(d->getNameInfo().getBeginLoc(), d->getNameInfo().getEndLoc());
     // Print out overrides
@@ -336,10 +296,10 @@ public:
       CXXMethodDecl::method_iterator iter = cxxd->begin_overridden_methods();
       if (iter) {
         recordValue("overridename", (*iter)->getQualifiedNameAsString());
-        recordValue("overrideloc", locationToString((*iter)->getLocation()));
+        recordLocation("overrideloc", (*iter)->getLocation());
       }
     }
-    *out << std::endl;
+    endRecord();
     const FunctionDecl *def;
     if (d->isDefined(def))
       declDef(d, def);
@@ -351,11 +311,11 @@ public:
       return;
     beginRecord("variable", d->getLocation());
     recordValue("vname", d->getQualifiedNameAsString());
-    recordValue("vloc", locationToString(d->getLocation()));
+    recordLocation("vloc", d->getLocation());
     recordValue("vtype", d->getType().getAsString(), true);
     printScope(d);
     printExtent(d->getLocation(), d->getLocation());
-    *out << std::endl;
+    endRecord();
   }
 
   bool VisitEnumConstantDecl(EnumConstantDecl *d) { visitVariableDecl(d); return true; }
@@ -379,11 +339,11 @@ public:
     beginRecord("typedef", d->getLocation());
     recordValue("tname", d->getNameAsString());
     recordValue("tqualname", d->getQualifiedNameAsString());
-    recordValue("tloc", locationToString(d->getLocation()));
+    recordLocation("tloc", d->getLocation());
     recordValue("ttypedef", d->getUnderlyingType().getAsString());
     printScope(d);
     printExtent(d->getLocation(), d->getLocation());
-    *out << std::endl;
+    endRecord();
     return true;
   }
 
@@ -411,10 +371,10 @@ public:
       return;
     beginRecord("ref", refLoc);
     recordValue("varname", d->getQualifiedNameAsString());
-    recordValue("varloc", locationToString(d->getLocation()));
-    recordValue("refloc", locationToString(refLoc));
+    recordLocation("varloc", d->getLocation());
+    recordLocation("refloc", refLoc);
     printExtent(refLoc, end);
-    *out << std::endl;
+    endRecord();
   }
   bool VisitMemberExpr(MemberExpr *e) {
     printReference(e->getMemberDecl(), e->getExprLoc(), e->getSourceRange().getEnd());
@@ -442,10 +402,10 @@ public:
     beginRecord("call", e->getLocStart());
     if (m_currentFunction) {
       recordValue("callername", m_currentFunction->getQualifiedNameAsString());
-      recordValue("callerloc", locationToString(m_currentFunction->getLocation()));
+      recordLocation("callerloc", m_currentFunction->getLocation());
     }
     recordValue("calleename", dyn_cast<NamedDecl>(callee)->getQualifiedNameAsString());
-    recordValue("calleeloc", locationToString(callee->getLocation()));
+    recordLocation("calleeloc", callee->getLocation());
     // Determine the type of call
     const char *type = "static";
     if (CXXMethodDecl::classof(callee)) {
@@ -461,7 +421,7 @@ public:
       type = "funcptr";
     }
     recordValue("calltype", type);
-    *out << std::endl;
+    endRecord();
     return true;
   }
 
@@ -502,9 +462,9 @@ public:
     info.FormatDiagnostic(message);
 
     beginRecord("warning", info.getLocation());
-    recordValue("wloc", locationToString(info.getLocation()));
+    recordLocation("wloc", info.getLocation());
     recordValue("wmsg", message.c_str(), true);
-    *out << std::endl;
+    endRecord();
   }
 
   // Macros!
@@ -543,7 +503,7 @@ public:
       break;
     }
     beginRecord("macro", nameStart);
-    recordValue("macroloc", locationToString(nameStart));
+    recordLocation("macroloc", nameStart);
     recordValue("macroname", std::string(contents, nameLen));
     if (argsStart > 0)
       recordValue("macroargs", std::string(contents + argsStart,
@@ -551,7 +511,7 @@ public:
     if (defnStart < length)
       recordValue("macrotext", std::string(contents + defnStart,
         length - defnStart), true);
-    *out << std::endl;
+    endRecord();
   }
   virtual void MacroExpands(const Token &tok, const MacroInfo *MI, SourceRange Range) {
     if (MI->isBuiltinMacro()) return;
@@ -562,10 +522,10 @@ public:
     IdentifierInfo *name = tok.getIdentifierInfo();
     beginRecord("ref", refLoc);
     recordValue("varname", std::string(name->getNameStart(), name->getLength()));
-    recordValue("varloc", locationToString(macroLoc));
-    recordValue("refloc", locationToString(refLoc));
+    recordLocation("varloc", macroLoc);
+    recordLocation("refloc", refLoc);
     printExtent(refLoc, refLoc);
-    *out << std::endl;
+    endRecord();
   }
 };
 
@@ -615,6 +575,7 @@ protected:
     }
     output = realpath(output.c_str(), NULL);
     output += "/";
+    binary = getenv("DXR_INDEX_BINARY") != NULL;
     return true;
   }
   void PrintHelp(llvm::raw_ostream& ros) {
@@ -0,0 +1,180 @@
+// The output side of dxr-index.cpp: the files we write and the csv and binary
+// record formats. Nothing in here depends on clang, so that the formats can be
+// exercised without it (see tests/unit/write-records.cpp).
+
+#include <iostream>
+#include <map>
+#include <sstream>
+#include <stdlib.h>
+#include <string.h>
+
+namespace {
+
+// Curse whomever didn't do this.
+std::string &operator+=(std::string &str, unsigned int i) {
+  static char buf[15] = { '\0' };
+  char *ptr = &buf[13];
+  do {
+    *ptr-- = (i % 10) + '0';
+    i = i/10;
+  } while (i > 0);
+  return str += (ptr + 1);
+}
+
+std::string srcdir;
+std::string output;
+bool binary;
+
+// The binary output format, which is written instead of the csv files when
+// DXR_INDEX_BINARY is set. A file starts with binaryMagic, and is followed by
+// string definitions and records:
+//   string: 0, varint length, bytes; strings are numbered from 0 in the order
+//           they are defined, and are defined before the record using them
+//   record: kind tag, fields, 0
+//   field:  key tag, then the value: a varint string number, or for the keys
+//           ending in loc, the varint string number of the file, line and
+//           column, or for extent, the varint start and end offsets.
+// Tags are the indexes in recordKinds and recordKeys plus one. The reader in
+// indexer.py has the same lists, so both must be kept in sync.
+const char binaryMagic[] = "DXRB\1";
+const char *recordKinds[] = {
+  "decldef", "type", "impl", "function", "variable", "typedef", "ref", "call",
+  "warning", "macro", NULL
+};
+const char *recordKeys[] = {
+  "name", "declloc", "defloc", "tname", "tqualname", "tloc", "tkind",
+  "scopename", "scopeloc", "extent", "tcname", "tcloc", "tbname", "tbloc",
+  "access", "fname", "fqualname", "ftype", "fargs", "floc", "overridename",
+  "overrideloc", "vname", "vloc", "vtype", "ttypedef", "varname", "varloc",
+  "refloc", "callername", "callerloc", "calleename", "calleeloc", "calltype",
+  "wloc", "wmsg", "macroloc", "macroname", "macroargs", "macrotext", NULL
+};
+
+char findTag(const char **table, const char *name) {
+  for (int i = 0; table[i]; i++)
+    if (!strcmp(table[i], name))
+      return i + 1;
+  // Every name we write has to be in the tables
+  abort();
+}
+
+void writeVarint(std::ostream &out, unsigned int value) {
+  while (value >= 0x80) {
+    out.put((char)((value & 0x7f) | 0x80));
+    value >>= 7;
+  }
+  out.put((char)value);
+}
+
+struct FileInfo {
+  FileInfo(std::string &rname) : realname(rname) {
+    interesting = rname.compare(0, srcdir.length(), srcdir) == 0;
+    if (interesting) {
+      // Remove the trailing `/' as well.
+      realname.erase(0, srcdir.length() + 1);
+    } else if (rname.compare(0, output.length(), output) == 0) {
+      // We're in the output directory, so we are probably a generated header
+      // We use the escape character to indicate the objdir nature.
+      // Note that output also has the `/' already placed
+      interesting = true;
+      realname.replace(0, output.length(), "--GENERATED--/");
+    }
+  }
+  // Returns the number of str in the binary output, defining it first if
+  // needed
+  unsigned int intern(const std::string &str) {
+    std::map<std::string, unsigned int>::iterator it = strings.find(str);
+    if (it != strings.end())
+      return it->second;
+    unsigned int id = strings.size();
+    strings.insert(make_pair(str, id));
+    info.put(0);
+    writeVarint(info, str.length());
+    info << str;
+    return id;
+  }
+  std::string realname;
+  std::ostringstream info;
+  std::map<std::string, unsigned int> strings;
+  bool interesting;
+};
+
+// Writes records into the info of their FileInfo, in the csv or the binary
+// format depending on binary.
+class RecordWriter {
+  std::ostream *out;
+  // In binary mode, the file and record being written
+  FileInfo *current;
+  std::ostringstream record;
+public:
+  RecordWriter() : out(NULL), current(NULL) {}
+
+  void beginRecord(const char *name, FileInfo *f) {
+    if (binary) {
+      // The record is kept aside until it is complete, so that the strings it
+      // defines come before it
+      current = f;
+      record.str("");
+      out = &record;
+      out->put(findTag(recordKinds, name));
+    } else {
+      out = &f->info;
+      *out << name;
+    }
+  }
+  void endRecord() {
+    if (binary) {
+      out->put(0);
+      current->info << record.str();
+    } else {
+      *out << std::endl;
+    }
+  }
+  void recordValue(const char *key, std::string value, bool needQuotes=false) {
+    if (binary) {
+      out->put(findTag(recordKeys, key));
+      writeVarint(*out, current->intern(value));
+      return;
+    }
+    *out << "," << key << ",\"";
+    int start = 0;
+    if (needQuotes) {
+      int quote = value.find('"');
+      while (quote != -1) {
+        // Need to repeat the "
+        *out << value.substr(start, quote - start + 1) << "\"";
+        start = quote + 1;
+        quote = value.find('"', start);
+      }
+    }
+    *out << value.substr(start) << "\"";
+  }
+  void recordLocation(const char *key, FileInfo *file, unsigned int line,
+      unsigned int column) {
+    if (!binary) {
+      std::string buffer = file->realname;
+      buffer += ":";
+      buffer += line;
+      buffer += ":";
+      buffer += column;
+      recordValue(key, buffer);
+      return;
+    }
+    unsigned int name = current->intern(file->realname);
+    out->put(findTag(recordKeys, key));
+    writeVarint(*out, name);
+    writeVarint(*out, line);
+    writeVarint(*out, column);
+  }
+  void recordExtent(unsigned int start, unsigned int stop) {
+    if (binary) {
+      out->put(findTag(recordKeys, "extent"));
+      writeVarint(*out, start);
+      writeVarint(*out, stop);
+    } else {
+      *out << ",extent," << start << ":" << stop;
+    }
+  }
+};
+
+}
@@ -1,11 +1,15 @@
 import csv
 from dxr.languages import register_language_table
 from dxr.languages import language_schema
+from collections import deque
+import dxr.graph
 import dxr.plugins
 import os
 import mmap
 
 file_cache = {}
+scope_map = {}
+scope_rows = []
 decl_master = {}
 inheritance = {}
 calls = {}
@@ -20,18 +24,31 @@ def getFileID(conn, path):
     return file_id
 
   cur = conn.cursor()
-  file_id = cur.execute("SELECT ID FROM files where path=?", (path,)).fetchone()
+  row = cur.execute("SELECT ID FROM files where path=?", (path,)).fetchone()
 
-  if file_id is None:
-    cur.execute("INSERT INTO files (path) VALUES (?)", (path,))
-    file_id = cur.lastrowid
+  if row is None:
+    # The walk stage adds the files of the tree at the same time
+    cur.execute("INSERT OR IGNORE INTO files (path) VALUES (?)", (path,))
+    row = cur.execute("SELECT ID FROM files where path=?", (path,)).fetchone()
 
+  file_id = row[0]
   file_cache[path] = file_id
   return file_id
 
-def splitLoc(conn, value):
+def parseLoc(value):
+  """ Splits a file:line:col location into a (file, line, col) tuple """
+  arr = value.split(':')
+  return (arr[0], int(arr[1]), int(arr[2]))
+
+def parseExtent(value):
+  """ Splits a start:end extent into a (start, end) tuple """
   arr = value.split(':')
-  return (getFileID(conn, arr[0]), int(arr[1]), int(arr[2]))
+  return (int(arr[0]), int(arr[1]))
+
+def splitLoc(conn, value):
+  if not isinstance(value, tuple):
+    value = parseLoc(value)
+  return (getFileID(conn, value[0]), value[1], value[2])
 
 def fixupEntryPath(args, file_key, conn, prefix=None):
   value = args[file_key]
@@ -51,20 +68,29 @@ def fixupExtent(args, extents_key):
     return
 
   value = args[extents_key]
-  arr = value.split(':')
+  if not isinstance(value, tuple):
+    value = parseExtent(value)
 
-  args['extent_start'] = int(arr[0])
-  args['extent_end'] = int(arr[1])
+  args['extent_start'] = value[0]
+  args['extent_end'] = value[1]
   del args[extents_key]
 
-def getScope(args, conn):
-  row = conn.execute("SELECT scopeid FROM scopes WHERE file_id=? AND file_line=? AND file_col=?",
-                     (args['file_id'], args['file_line'], args['file_col'])).fetchone()
+# All scopes are kept in scope_map, which maps their location to their scopeid,
+# and are only inserted into the scopes table once all files have been read.
+# Locations are packed into a single int where they fit, since that takes a
+# fraction of the memory of a tuple.
+def scopeKey(args):
+  file_id, line, col = args['file_id'], args['file_line'], args['file_col']
+  if line < (1 << 24) and col < (1 << 16):
+    return (file_id << 40) | (line << 16) | col
+  return (file_id, line, col)
 
-  if row is not None:
-    return row[0]
+def getScope(args, conn):
+  return scope_map.get(scopeKey(args))
 
-  return None
+def storeScope(scope):
+  scope_map[scopeKey(scope)] = scope['scopeid']
+  scope_rows.append(language_schema.get_row('scopes', scope))
 
 def addScope(args, conn, name, id):
   scope = {}
@@ -75,8 +101,7 @@ def addScope(args, conn, name, id):
   scope['file_col'] = args['file_col']
   scope['language'] = 'native'
 
-  stmt = language_schema.get_insert_sql('scopes', scope)
-  conn.execute(stmt[0], stmt[1])
+  storeScope(scope)
 
 def handleScope(args, conn, canonicalize=False):
   scope = {}
@@ -96,9 +121,8 @@ def handleScope(args, conn, canonicalize=False):
   scopeid = getScope(scope, conn)
 
   if scopeid is None:
-    scope['scopeid'] = scopeid = dxr.plugins.next_global_id()
-    stmt = language_schema.get_insert_sql('scopes', scope)
-    conn.execute(stmt[0], stmt[1])
+    scope['scopeid'] = scopeid = dxr.plugins.next_global_id(conn)
+    storeScope(scope)
 
   args['scopeid'] = scopeid
 
@@ -121,20 +145,20 @@ def process_type(args, conn):
   if scopeid is not None:
     args['tid'] = scopeid
   else:
-    args['tid'] = dxr.plugins.next_global_id()
+    args['tid'] = dxr.plugins.next_global_id(conn)
     addScope(args, conn, 'tname', 'tid')
 
   handleScope(args, conn)
   fixupExtent(args, 'extent')
 
-  return language_schema.get_insert_sql('types', args)
+  return ('types', args)
 
 def process_typedef(args, conn):
-  args['tid'] = dxr.plugins.next_global_id()
+  args['tid'] = dxr.plugins.next_global_id(conn)
   fixupEntryPath(args, 'tloc', conn)
   fixupExtent(args, 'extent')
 #  handleScope(args, conn)
-  return schema.get_insert_sql('typedefs', args)
+  return ('typedefs', args)
 
 def process_function(args, conn):
   fixupEntryPath(args, 'floc', conn)
@@ -143,7 +167,7 @@ def process_function(args, conn):
   if scopeid is not None:
     args['funcid'] = scopeid
   else:
-    args['funcid'] = dxr.plugins.next_global_id()
+    args['funcid'] = dxr.plugins.next_global_id(conn)
     addScope(args, conn, 'fname', 'funcid')
 
   if 'overridename' in args:
@@ -151,18 +175,21 @@ def process_function(args, conn):
 
   handleScope(args, conn)
   fixupExtent(args, 'extent')
-  return language_schema.get_insert_sql('functions', args)
+  return ('functions', args)
 
+# Relations that are resolved once all files are read only keep the values that
+# are needed for that, not the whole record.
 def process_impl(args, conn):
-  inheritance[args['tbname'], args['tbloc'], args['tcname'], args['tcloc']] = args
+  inheritance[args['tbname'], args['tbloc'], args['tcname'], args['tcloc']] = \
+    args.get('access', '')
   return None
 
 def process_variable(args, conn):
-  args['varid'] = dxr.plugins.next_global_id()
+  args['varid'] = dxr.plugins.next_global_id(conn)
   fixupEntryPath(args, 'vloc', conn)
   handleScope(args, conn)
   fixupExtent(args, 'extent')
-  return language_schema.get_insert_sql('variables', args)
+  return ('variables', args)
 
 def process_ref(args, conn):
   if 'extent' not in args:
@@ -172,88 +199,227 @@ def process_ref(args, conn):
   fixupEntryPath(args, 'varloc', conn, 'referenced')
   fixupExtent(args, 'extent')
 
-  return schema.get_insert_sql('refs', args)
+  return ('refs', args)
 
 def process_warning(args, conn):
   fixupEntryPath(args, 'wloc', conn)
-  return schema.get_insert_sql('warnings', args)
+  return ('warnings', args)
 
 def process_macro(args, conn):
-  args['macroid'] = dxr.plugins.next_global_id()
+  args['macroid'] = dxr.plugins.next_global_id(conn)
   if 'macrotext' in args:
     args['macrotext'] = args['macrotext'].replace("\\\n", "\n").strip()
   fixupEntryPath(args, 'macroloc', conn)
-  return schema.get_insert_sql('macros', args)
+  return ('macros', args)
 
 def process_call(args, conn):
   if 'callername' in args:
     calls[args['callername'], args['callerloc'],
-          args['calleename'], args['calleeloc']] = args
+          args['calleename'], args['calleeloc']] = args.get('calltype')
   else:
-    calls[args['calleename'], args['calleeloc']] = args
+    calls[args['calleename'], args['calleeloc']] = args.get('calltype')
 
   return None
 
-def load_indexer_output(fname):
-  f = open(fname, "rb")
+# The process_* function for each kind of CSV line. They return None, or the
+# (table, args) row to insert.
+processors = {
+  'decldef': process_decldef,
+  'type': process_type,
+  'typedef': process_typedef,
+  'function': process_function,
+  'impl': process_impl,
+  'variable': process_variable,
+  'ref': process_ref,
+  'warning': process_warning,
+  'macro': process_macro,
+  'call': process_call
+}
+
+# The locations that the process_* function of each kind of record reads. Only
+# these are split ahead of time; splitLoc parses any other one when needed.
+location_keys = {
+  'decldef': ('declloc', 'defloc'),
+  'type': ('tloc', 'scopeloc'),
+  'typedef': ('tloc',),
+  'function': ('floc', 'scopeloc', 'overrideloc'),
+  'impl': ('tbloc', 'tcloc'),
+  'variable': ('vloc', 'scopeloc'),
+  'ref': ('refloc', 'varloc'),
+  'warning': ('wloc',),
+  'macro': ('macroloc',),
+  'call': ('callerloc', 'calleeloc')
+}
+
+def parse_indexer_output(fname):
+  """ Reads a CSV or binary file into a list of (kind, args) records, with the
+      locations and extents that are used already split. This is the part of
+      the ingest that does not need the database, so it runs in worker
+      processes. """
+  if fname.endswith('.dxrb'):
+    return list(read_binary_output(fname))
+  records = []
+  f = open(fname, 'rb')
   try:
-    parsed_iter = csv.reader(f)
-    for line in parsed_iter:
+    for line in csv.reader(f):
       # Our first column is the type that we're reading, the others are just
-      # an args array to be passed in
-      argobj = {}
-      for i in range(1, len(line), 2):
-        argobj[line[i]] = line[i + 1]
-      globals()['process_' + line[0]](argobj)
+      # a key/value pairs array to be passed in
+      kind = line[0]
+      args = dict(zip(line[1::2], line[2::2]))
+      # process_ref drops the references without an extent
+      if kind == 'ref' and 'extent' not in args:
+        continue
+      for key in location_keys.get(kind, ()):
+        if key in args:
+          args[key] = parseLoc(args[key])
+      if 'extent' in args:
+        args['extent'] = parseExtent(args['extent'])
+      records.append((kind, args))
   except:
-    print fname, line
+    print 'Error parsing %s' % fname
     raise
   finally:
     f.close()
-
-def dump_indexer_output(conn, fname):
-  f = open(fname, 'r')
-  limit = 0
-
+  return records
+
+# The binary output of dxr-index.cpp, written when DXR_INDEX_BINARY is set. The
+# format is described there; these lists must be the same as its recordKinds
+# and recordKeys.
+binary_magic = 'DXRB\x01'
+record_kinds = [
+  'decldef', 'type', 'impl', 'function', 'variable', 'typedef', 'ref', 'call',
+  'warning', 'macro'
+]
+record_keys = [
+  'name', 'declloc', 'defloc', 'tname', 'tqualname', 'tloc', 'tkind',
+  'scopename', 'scopeloc', 'extent', 'tcname', 'tcloc', 'tbname', 'tbloc',
+  'access', 'fname', 'fqualname', 'ftype', 'fargs', 'floc', 'overridename',
+  'overrideloc', 'vname', 'vloc', 'vtype', 'ttypedef', 'varname', 'varloc',
+  'refloc', 'callername', 'callerloc', 'calleename', 'calleeloc', 'calltype',
+  'wloc', 'wmsg', 'macroloc', 'macroname', 'macroargs', 'macrotext'
+]
+# How to read the value of each key: 's' for strings, 'l' for locations and
+# 'e' for extents
+key_formats = [key == 'extent' and 'e' or key.endswith('loc') and 'l' or 's'
+               for key in record_keys]
+
+def read_varint(data, pos):
+  """ Returns the varint at pos in data, and the position after it """
+  value, shift = 0, 0
+  while True:
+    byte = ord(data[pos])
+    pos += 1
+    value |= (byte & 0x7f) << shift
+    if byte < 0x80:
+      return value, pos
+    shift += 7
+
+def read_binary_output(fname):
+  """ Yields the (kind, args) records of a binary file, in the same form as
+      parse_indexer_output. The file is memory-mapped, and every string is only
+      read once: the records all share the same string objects. """
+  f = open(fname, 'rb')
   try:
-    parsed_iter = csv.reader(f)
-    for line in parsed_iter:
-      args = {}
-      # Our first column is the type that we're reading, the others are just
-      # a key/value pairs array to be passed in
-      for i in range(1, len(line), 2):
-        args[line[i]] = line[i + 1]
-
-      stmt = globals()['process_' + line[0]](args, conn)
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  finally:
+    f.close()
 
-      if stmt is None:
+  try:
+    if data[:len(binary_magic)] != binary_magic:
+      raise ValueError('%s is not a binary indexer output file' % fname)
+    strings = []
+    pos, size = len(binary_magic), len(data)
+    while pos < size:
+      tag = ord(data[pos])
+      pos += 1
+      if tag == 0:
+        length, pos = read_varint(data, pos)
+        strings.append(data[pos:pos + length])
+        pos += length
         continue
 
-      if isinstance(stmt, list):
-        for elem in list:
-          conn.execute(elem[0], elem[1])
-      elif isinstance(stmt, tuple):
-        conn.execute(stmt[0], stmt[1])
-      else:
-        conn.execute(stmt)
-
-      limit = limit + 1
-
-      if limit > 10000:
-        limit = 0
-        conn.commit()
-  except IndexError, e:
-    raise e
+      args = {}
+      while True:
+        key = ord(data[pos])
+        pos += 1
+        if key == 0:
+          break
+        fmt = key_formats[key - 1]
+        if fmt == 's':
+          index, pos = read_varint(data, pos)
+          value = strings[index]
+        elif fmt == 'l':
+          index, pos = read_varint(data, pos)
+          line, pos = read_varint(data, pos)
+          col, pos = read_varint(data, pos)
+          value = (strings[index], line, col)
+        else:
+          start, pos = read_varint(data, pos)
+          end, pos = read_varint(data, pos)
+          value = (start, end)
+        args[record_keys[key - 1]] = value
+      yield (record_kinds[tag - 1], args)
+  except Exception:
+    print 'Error parsing %s' % fname
+    raise
   finally:
-    f.close()
+    data.close()
+
+def dump_indexer_output(conn, records, inserter):
+  for kind, args in records:
+    row = processors[kind](args, conn)
+
+    if row is not None:
+      inserter.add(row[0], row[1])
+
+def parse_all(fnames, workers):
+  """ Yields the parsed records of each file, in order. The files are parsed
+      in the worker pool of the plugins, a few files ahead of the one being
+      yielded, so that the parsed data waiting to be consumed stays bounded. """
+  pool = dxr.plugins.get_pool()
+  pending = deque()
+  for fname in fnames:
+    pending.append(pool.apply_async(parse_indexer_output, (fname,)))
+    if len(pending) >= workers * 4:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
 
 file_names = []
 def collect_files(arg, dirname, fnames):
+  # arg is the tuple of the extensions to collect
   for name in fnames:
     if os.path.isdir(name): continue
     if not name.endswith(arg): continue
     file_names.append(os.path.join(dirname, name))
 
+def get_csv_key(fname):
+  """ Returns the (filehash, contenthash) of a file written by dxr-index.cpp,
+      which names them hash(realname).hash(content).csv (or .dxrb), or None
+      for files named otherwise. """
+  parts = os.path.basename(fname).split('.')
+  if len(parts) == 3 and len(parts[0]) == 40 and len(parts[1]) == 40:
+    return (parts[0], parts[1])
+  return None
+
+def select_files(fnames):
+  """ Returns the files to ingest in a stable order. Files with the same source
+      and content hash hold the same records, so only the first of them is
+      read. """
+  selected, keys = [], set()
+  duplicates = 0
+  for fname in sorted(fnames):
+    key = get_csv_key(fname)
+    if key in keys:
+      duplicates += 1
+    else:
+      selected.append(fname)
+      if key is not None:
+        keys.add(key)
+  print "Ingesting %d of %d indexer output files (%d duplicates)" % (
+    len(selected), len(fnames), duplicates)
+  return selected
+
 def canonicalize_decl(name, id, line, col):
   value = decl_master.get((name, id, line, col), None)
 
@@ -266,17 +432,39 @@ def recanon_decl(name, loc):
   decl_master[name, loc] = loc
   return (name, loc)
 
+# Every symbol that is looked up by location after the ingest (for refs, scopes
+# and declarations) is collected into the temporary symbol_locations table, so
+# that each of them is resolved with a single indexed lookup. Declarations are
+# also matched by the name in the last column.
+symbol_tables = [
+  ('macro', 'macros', 'macroid', 'macroname'),
+  ('type', 'types', 'tid', 'tname'),
+  ('function', 'functions', 'funcid', 'fname'),
+  ('typedef', 'typedefs', 'tid', 'ttypedef'),
+  ('variable', 'variables', 'varid', 'vname'),
+  ('scope', 'scopes', 'scopeid', 'sname')
+]
+
+def build_symbol_locations(conn):
+  print "Building symbol locations..."
+  conn.execute("CREATE TEMP TABLE symbol_locations (file_id INTEGER, " +
+               "file_line INTEGER, file_col INTEGER, kind VARCHAR(16), id INTEGER, " +
+               "name VARCHAR(256))")
+  for kind, tblname, idcol, namecol in symbol_tables:
+    conn.execute("INSERT INTO symbol_locations SELECT file_id, file_line, file_col, ?, %s, %s FROM %s" %
+                 (idcol, namecol, tblname), (kind,))
+  conn.execute("CREATE INDEX temp.symbol_locations_index ON symbol_locations " +
+               "(file_id, file_line, file_col, kind, id)")
+
+def drop_symbol_locations(conn):
+  conn.execute("DROP TABLE temp.symbol_locations")
+
 def fixup_scope(conn):
   print "Fixing up scopes..."
-  conn.execute ("UPDATE types SET scopeid = (SELECT scopeid FROM scopes WHERE " +
-                "scopes.file_id = types.file_id AND scopes.file_line = types.file_line " +
-                "AND scopes.file_col = types.file_col) WHERE scopeid IS NULL")
-  conn.execute ("UPDATE functions SET scopeid = (SELECT scopeid from scopes where " +
-                "scopes.file_id = functions.file_id AND scopes.file_line = functions.file_line " +
-                "AND scopes.file_col = functions.file_col) WHERE scopeid IS NULL")
-  conn.execute ("UPDATE variables SET scopeid = (SELECT scopeid from scopes where " +
-                "scopes.file_id = variables.file_id AND scopes.file_line = variables.file_line " +
-                "AND scopes.file_col = variables.file_col) WHERE scopeid IS NULL")
+  for tblname in ('types', 'functions', 'variables'):
+    conn.execute("UPDATE %s SET scopeid = (SELECT id FROM symbol_locations s WHERE " % tblname +
+                 "s.file_id = %s.file_id AND s.file_line = %s.file_line " % (tblname, tblname) +
+                 "AND s.file_col = %s.file_col AND s.kind = 'scope') WHERE scopeid IS NULL" % tblname)
 
 
 def build_inherits(base, child, direct):
@@ -286,46 +474,41 @@ def build_inherits(base, child, direct):
   return db
 
 def generate_inheritance(conn):
-  childMap, parentMap = {}, {}
   types = {}
 
   for row in conn.execute("SELECT tqualname, file_id, file_line, file_col, tid from types").fetchall():
     types[(row[0], row[1], row[2], row[3])] = row[4]
 
-  for infoKey in inheritance:
-    info = inheritance[infoKey]
+  # Build the graph of direct base classes first, and compute the transitive
+  # closure of it in one go. Direct relations keep their kind of inheritance,
+  # indirect ones have none.
+  direct = {}
+  bases = {}
+  for infoKey in sorted(inheritance):
+    tbname, tbloc, tcname, tcloc = infoKey
     try:
-      base_loc = splitLoc(conn, info['tbloc'])
-      child_loc = splitLoc(conn, info['tcloc'])
+      base_loc = splitLoc(conn, tbloc)
+      child_loc = splitLoc(conn, tcloc)
 
-      base = types[canonicalize_decl(info['tbname'], base_loc[0], base_loc[1], base_loc[2])]
-      child = types[canonicalize_decl(info['tcname'], child_loc[0], child_loc[1], child_loc[2])]
+      base = types[canonicalize_decl(tbname, base_loc[0], base_loc[1], base_loc[2])]
+      child = types[canonicalize_decl(tcname, child_loc[0], child_loc[1], child_loc[2])]
     except KeyError:
       continue
 
-    conn.execute("INSERT OR IGNORE INTO impl(tbase, tderived, inhtype) VALUES (?, ?, ?)",
-                 (base, child, info.get('access', '')))
-
-    # Get all known relations
-    subs = childMap.setdefault(child, [])
-    supers = parentMap.setdefault(base, [])
-    # Use this information
-    for sub in subs:
-      conn.execute("INSERT OR IGNORE INTO impl(tbase, tderived) VALUES (?, ?)",
-                   (base, sub))
-      parentMap[sub].append(base)
-    for sup in supers:
-      conn.execute("INSERT OR IGNORE INTO impl(tbase, tderived) VALUES (?, ?)",
-                   (sup, child))
-      childMap[sup].append(child)
-
-    # Carry through these relations
-    newsubs = childMap.setdefault(base, [])
-    newsubs.append(child)
-    newsubs.extend(subs)
-    newsupers = parentMap.setdefault(child, [])
-    newsupers.append(base)
-    newsupers.extend(supers)
+    direct.setdefault((base, child), inheritance[infoKey])
+    bases.setdefault(child, set()).add(base)
+
+  del types
+  ancestors = dxr.graph.reachable(bases)
+  rows = []
+  for child, supers in ancestors.iteritems():
+    for base in supers:
+      if base != child or (base, child) in direct:
+        rows.append((base, child, direct.get((base, child))))
+  conn.executemany("INSERT OR IGNORE INTO impl(tbase, tderived, inhtype) VALUES (?, ?, ?)",
+                   rows)
+  print "Inheritance: %d direct and %d indirect relations" % (len(direct),
+    len(rows) - len(direct))
 
 
 def generate_callgraph(conn):
@@ -343,27 +526,28 @@ def generate_callgraph(conn):
     variables[(row[0], row[1], row[2], row[3])] = row[4]
 
   # Generate callers table
-  for call in calls.values():
-    if 'callername' in call:
-      caller_loc = splitLoc(conn, call['callerloc'])
-      source = canonicalize_decl(call['callername'], caller_loc[0], caller_loc[1], caller_loc[2])
-      call['callerid'] = functions.get(source)
-
-      if call['callerid'] is None:
+  for call, calltype in calls.iteritems():
+    if len(call) == 4:
+      callername, callerloc, calleename, calleeloc = call
+      caller_loc = splitLoc(conn, callerloc)
+      source = canonicalize_decl(callername, caller_loc[0], caller_loc[1], caller_loc[2])
+      callerid = functions.get(source)
+
+      if callerid is None:
         continue
     else:
-      call['callerid'] = 0
+      calleename, calleeloc = call
+      callerid = 0
 
-    target_loc = splitLoc(conn, call['calleeloc'])
-    target = canonicalize_decl(call['calleename'], target_loc[0], target_loc[1], target_loc[2])
+    target_loc = splitLoc(conn, calleeloc)
+    target = canonicalize_decl(calleename, target_loc[0], target_loc[1], target_loc[2])
     targetid = functions.get(target)
 
     if targetid is None:
       targetid = variables.get(target)
 
     if targetid is not None:
-      call['targetid'] = targetid
-      callgraph.append(call)
+      callgraph.append((callerid, targetid, calltype))
 
   del variables
 
@@ -387,73 +571,54 @@ def generate_callgraph(conn):
 
     overridemap.setdefault(basekey, set()).add(funcid)
 
-  rescan = [x for x in overridemap]
-  while len(rescan) > 0:
-    base = rescan.pop(0)
-    childs = overridemap[base]
-    prev = len(childs)
-    temp = childs.union(*(overridemap.get(sub, []) for sub in childs))
-    childs.update(temp)
-    if len(childs) != prev:
-      rescan.append(base)
-
-  for base, childs in overridemap.iteritems():
-    conn.execute("INSERT OR IGNORE INTO targets (targetid, funcid) VALUES (?, ?)",
-                 (-base, base));
-
-    for child in childs:
-      conn.execute("INSERT OR IGNORE INTO targets (targetid, funcid) VALUES (?, ?)",
-                   (-base, child));
-
-  for call in callgraph:
-    if call['calltype'] == 'virtual':
-      targetid = call['targetid']
-      call['targetid'] = -targetid
-      if targetid not in overridemap:
-        overridemap[targetid] = set()
-        conn.execute("INSERT OR IGNORE INTO targets (targetid, funcid) VALUES (?, ?)",
-                     (-targetid, targetid));
-    conn.execute("INSERT OR IGNORE INTO callers (callerid, targetid) VALUES (?, ?)",
-                  (call['callerid'], call['targetid']))
+  # Every base method can be dispatched to all of its overrides, including the
+  # indirect ones
+  closure = dxr.graph.reachable(overridemap)
 
-def remap_declarations(conn):
-  tmap = [ ('types', ['tname', 'tid']),
-           ('functions', ['fname', 'funcid']),
-           ('typedefs', ['ttypedef', 'tid']),
-           ('variables', ['vname', 'varid']) ]
+  targets = []
+  for base in overridemap:
+    targets.append((-base, base))
+    for child in closure[base]:
+      targets.append((-base, child))
+  del closure
 
-  for tblname, cols in tmap:
-    cache = {}
-
-    for row in conn.execute("SELECT %s,file_id, file_line, file_col FROM %s" % (','.join(cols), tblname)).fetchall():
-      cache[(row[0], row[2], row[3], row[4])] = row[1]
-
-    for decl in decl_master:
-      decl_value = decl_master[decl]
-      defn = (decl[0], decl_value[0], decl_value[1], decl_value[2])
-
-      if defn == decl:
-        continue
-
-      def_id = cache.get(defn)
+  callers = []
+  for callerid, targetid, calltype in callgraph:
+    if calltype == 'virtual':
+      if targetid not in overridemap:
+        targets.append((-targetid, targetid))
+      targetid = -targetid
+    callers.append((callerid, targetid))
 
-      if def_id is not None:
-        conn.execute ("INSERT OR IGNORE INTO decldef (file_id, file_line, file_col, defid) VALUES (?, ?, ?, ?)",
-                      (decl[1], decl[2], decl[3], def_id));
+  conn.executemany("INSERT OR IGNORE INTO targets (targetid, funcid) VALUES (?, ?)",
+                   targets)
+  conn.executemany("INSERT OR IGNORE INTO callers (callerid, targetid) VALUES (?, ?)",
+                   callers)
 
-    del cache
+def remap_declarations(conn):
+  conn.execute("CREATE TEMP TABLE decl_locations (name VARCHAR(256), file_id INTEGER, " +
+               "file_line INTEGER, file_col INTEGER, def_file_id INTEGER, " +
+               "def_file_line INTEGER, def_file_col INTEGER)")
+  conn.executemany("INSERT INTO decl_locations VALUES (?, ?, ?, ?, ?, ?, ?)",
+                   (decl + defn for decl, defn in decl_master.iteritems()
+                    if decl[1:] != defn))
+
+  # A definition is looked for in each table in turn, the first one wins. It
+  # has to be at the location of the definition, under the same name.
+  for kind in ('type', 'function', 'typedef', 'variable'):
+    conn.execute("INSERT OR IGNORE INTO decldef (file_id, file_line, file_col, defid) " +
+                 "SELECT d.file_id, d.file_line, d.file_col, s.id FROM decl_locations d, " +
+                 "symbol_locations s WHERE s.file_id = d.def_file_id AND " +
+                 "s.file_line = d.def_file_line AND s.file_col = d.def_file_col AND " +
+                 "s.kind = ? AND s.name = d.name", (kind,))
+  conn.execute("DROP TABLE temp.decl_locations")
 
 def update_refs(conn):
   print "Updating refs..."
-  conn.execute ("UPDATE refs SET refid = ("+
-                "SELECT macroid FROM macros WHERE macros.file_id = refs.referenced_file_id AND " +
-                "macros.file_line = refs.referenced_file_line AND macros.file_col = refs.referenced_file_col UNION " +
-                "SELECT tid from types where types.file_id = refs.referenced_file_id AND " +
-                "types.file_line = refs.referenced_file_line AND types.file_col = refs.referenced_file_col UNION " +
-                "SELECT funcid FROM functions WHERE functions.file_id = refs.referenced_file_id AND " +
-                "functions.file_line = refs.referenced_file_line AND functions.file_col = refs.referenced_file_col UNION " +
-                "SELECT varid FROM variables WHERE variables.file_id = refs.referenced_file_id AND " +
-                "variables.file_line = refs.referenced_file_line AND variables.file_col = refs.referenced_file_col)")
+  conn.execute("UPDATE refs SET refid = (SELECT MIN(id) FROM symbol_locations s WHERE " +
+               "s.file_id = refs.referenced_file_id AND s.file_line = refs.referenced_file_line " +
+               "AND s.file_col = refs.referenced_file_col AND " +
+               "s.kind IN ('macro', 'type', 'function', 'variable'))")
 
 
 def post_process(srcdir, objdir):
@@ -462,25 +627,43 @@ def post_process(srcdir, objdir):
 
 def build_database(conn, srcdir, objdir, cache=None):
   count = 0
-  os.path.walk(objdir, collect_files, ".csv")
+  os.path.walk(objdir, collect_files, (".csv", ".dxrb"))
 
   if file_names == []:
-    raise IndexError('No .csv files in %s' % objdir)
-  for f in file_names:
-    dump_indexer_output(conn, f)
+    raise IndexError('No .csv or .dxrb files in %s' % objdir)
+  selected = select_files(file_names)
+
+  # Rows are inserted in batches, and scopes once all files are read. Since the
+  # files are always processed in the same order, so are the records that end
+  # up in the global dictionaries.
+  inserter = dxr.plugins.BulkInserter(conn, [language_schema, schema])
+  for records in parse_all(selected, dxr.plugins.get_workers()):
+    dump_indexer_output(conn, records, inserter)
     count = count + 1
 
     if count % 1000 == 0:
       conn.commit()
+  inserter.flush()
+  language_schema.insert_rows(conn, 'scopes', scope_rows)
+  del scope_rows[:]
+  conn.commit()
 
+  return None
+
+def link_database(conn, srcdir, objdir, cache=None):
+  # The passes below run once the rows that INSERT OR IGNORE would have
+  # dropped are gone, but before the lookup indexes, which would only slow
+  # their updates down.
+  build_symbol_locations(conn)
   fixup_scope(conn)
   print "Generating callgraph..."
   generate_callgraph(conn)
   print "Generating inheritances..."
   generate_inheritance(conn)
   print "Remapping declarations-definitions..."
-  remap_declarations(conn);
+  remap_declarations(conn)
   update_refs(conn)
+  drop_symbol_locations(conn)
 
   conn.commit()
 
@@ -506,6 +689,7 @@ schema = dxr.plugins.Schema({
     ("extent_end", "INTEGER", True),
     ("_location", True),
     ("_key", "tid"),
+    ("_sequenced",),
     ("_index", "ttypedef")
   ],
   # References to functions, types, variables, etc.
@@ -514,7 +698,10 @@ schema = dxr.plugins.Schema({
     ("extent_start", "INTEGER", True),
     ("extent_end", "INTEGER", True),
     ("_location", True),
-    ("_location", True, 'referenced')
+    ("_location", True, 'referenced'),
+    ("_lookup", "refid", "refid"),
+    # The links of a file, in the order they are made
+    ("_lookup", "file", "file_id", "extent_start", "extent_end", "refid")
   ],
   # Warnings found while compiling
   "warnings": [
@@ -525,6 +712,7 @@ schema = dxr.plugins.Schema({
   "decldef": [
     ("defid", "INTEGER", False),    # ID of the definition instance
     ("_location", True),
+    ("_lookup", "defid", "defid")
   ],
   # Macros: this is a table of all of the macros we come across in the code.
   "macros": [
@@ -532,7 +720,8 @@ schema = dxr.plugins.Schema({
     ("macroname", "VARCHAR(256)", False), # The name of the macro
     ("macroargs", "VARCHAR(256)", True),  # The args of the macro (if any)
     ("macrotext", "TEXT", True),          # The macro contents
-    ("_location", True)
+    ("_location", True),
+    ("_lookup", "name", "macroname")
   ],
   # The following two tables are combined to form the callgraph implementation.
   # In essence, the callgraph can be viewed as a kind of hypergraph, where the
@@ -545,17 +734,22 @@ schema = dxr.plugins.Schema({
     ("callerid", "INTEGER", False), # The function in which the call occurs
     ("targetid", "INTEGER", False), # The target of the call
     ("_key", "callerid", "targetid"),
-    ("_fkey", "callerid", "functions", "funcid")
+    ("_fkey", "callerid", "functions", "funcid"),
+    ("_lookup", "targetid", "targetid", "callerid")
   ],
   "targets": [
     ("targetid", "INTEGER", False), # The target of the call
     ("funcid", "INTEGER", False),   # One of the functions in the target set
     ("_key", "targetid", "funcid"),
-    ("_fkey", "targetid", "functions", "funcid")
+    ("_fkey", "targetid", "functions", "funcid"),
+    ("_lookup", "funcid", "funcid", "targetid")
   ]
 })
 
 get_schema = dxr.plugins.make_get_schema_func(schema)
+build_indexes = dxr.plugins.make_build_indexes_func(language_schema, schema)
+get_table_access = dxr.plugins.make_get_table_access_func(language_schema,
+                                                          schema)
 
 import dxr
 from dxr.tokenizers import CppTokenizer
@@ -688,4 +882,5 @@ for f in ('.c', '.cc', '.cpp', '.h', '.hpp'):
 def get_htmlifiers():
   return htmlifier
 
-__all__ = dxr.plugins.required_exports()
+__all__ = dxr.plugins.required_exports() + ['build_indexes', 'get_table_access',
+                                             'link_database']
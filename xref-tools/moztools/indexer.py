@@ -1,6 +1,7 @@
 import csv
 import dxr.plugins
 import os
+import sqlite3
 
 # Unlike the native code, we index here by interface name, since that is a unit
 # that we use in the xpt reflection and is guaranteed to be unique. It's also
@@ -43,6 +44,13 @@ location_keys = {
   'consts': 'loc'
 }
 
+# The ID column of the tables whose rows are keyed by it
+id_columns = {
+  "attributes": "attrid",
+  "methods": "funcid",
+  "consts": "constid"
+}
+
 def post_process(srcdir, objdir):
   file_names = []
   def collect_files(arg, dirname, fnames):
@@ -54,24 +62,12 @@ def post_process(srcdir, objdir):
   for f in file_names:
     load_indexer_output(f)
 
+  # The IDs are given out by build_database, which has a connection to reserve
+  # them on; until then, the rows are keyed by interface and name
   blob = {}
-  blob["interfaces"] = {}
-  for iface in interfaces:
-    blob["interfaces"][iface] = interfaces[iface]
-    interfaces[iface]["iid"] = dxr.plugins.next_global_id()
-  tblmap = {
-    "attributes": "attrid",
-    "methods": "funcid",
-    "consts": "constid"
-  }
-  for table in tblmap:
-    blob[table] = {}
-    things = globals()[table]
-    for thing, tinfo in things.iteritems():
-      id = dxr.plugins.next_global_id()
-      blob[table][id] = tinfo
-      tinfo[tblmap[table]] = id
-      tinfo["iid"] = interfaces[tinfo["iface"]]["iid"]
+  blob["interfaces"] = dict(interfaces)
+  for table in id_columns:
+    blob[table] = dict(globals()[table])
   for tblname, lockey in location_keys.iteritems():
     # Fix absolute/relative path issues
     for row in blob[tblname].itervalues():
@@ -81,7 +77,11 @@ def post_process(srcdir, objdir):
   return blob
 
 def pre_html_process(treecfg, blob):
-  blob["byfile"] = dxr.plugins.break_into_files(blob, location_keys)
+  conn = sqlite3.connect(treecfg.database)
+  try:
+    blob["byfile"] = dxr.plugins.break_into_files(blob, location_keys, conn)
+  finally:
+    conn.close()
 
 def can_use(treecfg):
   # Don't know? just guess!
@@ -103,17 +103,35 @@ def getFileID(conn, path):
     return file_id
 
   cur = conn.cursor()
-  file_id = cur.execute("SELECT ID FROM files where path=?", (path,)).fetchone()
+  row = cur.execute("SELECT ID FROM files where path=?", (path,)).fetchone()
 
-  if file_id is None:
-    cur.execute("INSERT INTO files (path) VALUES (?)", (path,))
-    file_id = cur.lastrowid
+  if row is None:
+    # The walk stage adds the files of the tree at the same time
+    cur.execute("INSERT OR IGNORE INTO files (path) VALUES (?)", (path,))
+    row = cur.execute("SELECT ID FROM files where path=?", (path,)).fetchone()
 
+  file_id = row[0]
   file_cache[path] = file_id
   return file_id
 
 
 def build_database(conn, srcdir, objdir, cache=None):
+  for iface in sorted(interfaces):
+    interfaces[iface]["iid"] = dxr.plugins.next_global_id(conn)
+  for table, idcol in id_columns.iteritems():
+    things = cache[table]
+    cache[table] = {}
+    for thing in sorted(things):
+      tinfo = things[thing]
+      id = dxr.plugins.next_global_id(conn)
+      cache[table][id] = tinfo
+      tinfo[idcol] = id
+      tinfo["iid"] = interfaces[tinfo["iface"]]["iid"]
+  conn.commit()
+
+def link_database(conn, srcdir, objdir, cache=None):
+  # The types come from the other plugins, and UPDATE OR IGNORE needs their
+  # unique index; both are there by now.
   for iface, info in interfaces.iteritems():
     loc = info['iloc'].split(':')
 
@@ -127,6 +145,9 @@ def build_database(conn, srcdir, objdir, cache=None):
 
   conn.commit()
 
+def get_table_access():
+  return [], ['global_ids']
+
 schema = dxr.plugins.Schema({
   # Scope definitions: a scope is anything that is both interesting (i.e., not
   # a namespace) and can contain other objects. The IDs for this scope should be
@@ -291,4 +312,4 @@ htmlifier = {
 def get_htmlifiers():
   return htmlifier
 
-__all__ = dxr.plugins.required_exports()
+__all__ = dxr.plugins.required_exports() + ['get_table_access', 'link_database']